@@ -0,0 +1,60 @@
+import multiprocessing
+
+import base58
+import pywaves as pw
+
+from seeds import as_seed, entropy_seed, new_entropy
+from workers import imap_window
+
+def offline_address(seed):
+    # derive the keys offline, pywaves does an alias lookup for every address created while online
+    offline = pw.OFFLINE
+    pw.setOffline()
+    try:
+        return pw.Address(seed=seed)
+    finally:
+        if not offline:
+            pw.setOnline()
+
+def seed_address(seed):
+    # seed is a mnemonic or the entropy of a compacted one
+    return offline_address(as_seed(seed)).address
+
+def address_chain_id(address):
+    # the second byte of an address is the chain id of the network it belongs to
+    return chr(base58.b58decode(address)[1])
+
+def stored_address(address, seed):
+    # use the stored address if it is for the current network, otherwise derive it from the seed
+    if address and address_chain_id(address) == pw.CHAIN_ID:
+        return address
+    return seed_address(seed)
+
+def foil_address(foil):
+    return stored_address(foil.address, foil.stored_seed)
+
+def init_offline_worker(chain, chain_id):
+    # worker processes derive addresses and sign offline on the parent's network
+    pw.setOffline()
+    pw.setChain(chain, chain_id)
+
+def derive_addresses(items, processes=None, seed=None, chunksize=64):
+    # derive addresses on a process pool, yielding (item, address) in the order of items, seed(item) is the seed
+    # or its entropy, compacted seeds are turned back into mnemonics in the workers
+    with multiprocessing.Pool(processes, init_offline_worker, (pw.CHAIN, pw.CHAIN_ID)) as pool:
+        yield from imap_window(pool, seed_address, items, seed, chunksize)
+
+def _new_seed_address(_):
+    addr = pw.Address()
+    return addr.seed, addr.address
+
+def _new_compact_address(_):
+    entropy = new_entropy()
+    return entropy, seed_address(entropy_seed(entropy))
+
+def generate_addresses(count, processes=None, chunksize=256, compact=False):
+    # generate count new (seed, address) pairs on a process pool, compact seeds are 12 word bip39 mnemonics
+    # returned as their entropy
+    new = _new_compact_address if compact else _new_seed_address
+    with multiprocessing.Pool(processes, init_offline_worker, (pw.CHAIN, pw.CHAIN_ID)) as pool:
+        yield from pool.imap_unordered(new, range(count), chunksize)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3.7
+
+# run zap_foil.py commands end to end against the fake node and a scratch database of synthetic foils,
+# reporting wall time and node requests for each
+
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pywaves as pw
+
+from addresses import seed_address
+from fake_node import FakeNode, FakeNodeServer
+
+# a valid bip39 mnemonic so fund does not ask for confirmation, the fake node gives its account any balance
+FUNDING_SEED = "abandon abandon abandon abandon abandon abandon abandon abandon abandon abandon abandon about"
+FUNDING_AMOUNT = 100
+BATCH_SIZE = 1000
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+COMMANDS = ["create", "fund", "check_multiple", "confirm", "fill_missing_fund_data", "sweep"]
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+class Bench:
+    def __init__(self, args, size, url, sender):
+        self.args = args
+        self.size = size
+        self.url = url
+        self.sender = sender
+        self.batch_count = max(1, size // BATCH_SIZE)
+        self.batch_start = 1000
+        self.batch_end = self.batch_start + self.batch_count - 1
+        self.db_filename = os.path.join(args.workdir, f"foils_{size}.db")
+        self.spec_filename = os.path.join(args.workdir, f"spec_{size}.json")
+        with open(self.spec_filename, "w") as f:
+            json.dump([[batch, FUNDING_AMOUNT] for batch in range(self.batch_start, self.batch_end + 1)], f)
+
+    def command_args(self, command):
+        batches = [str(self.batch_start), str(self.batch_end)]
+        if command == "create":
+            return ["create", str(min(self.size, BATCH_SIZE)), str(self.batch_count)]
+        if command == "fund":
+            return ["fund_multiple", "-M", self.spec_filename]
+        if command == "check_multiple":
+            return ["check_multiple", self.spec_filename]
+        if command == "confirm":
+            return ["confirm", "-g", "0"]
+        if command == "fill_missing_fund_data":
+            return ["fill_missing_fund_data"] + batches
+        if command == "sweep":
+            # broadcasts are not rate limited either, like the node requests
+            return ["sweep", "-r", "0", self.sender] + batches + ["1"]
+        raise ValueError(f"unknown command {command}")
+
+    def prepare(self, command):
+        if command == "create" and os.path.exists(self.db_filename):
+            os.remove(self.db_filename)
+        if command == "fill_missing_fund_data":
+            # forget the funding so it has to be recovered from the node
+            with sqlite3.connect(self.db_filename) as db:
+                db.execute("UPDATE foils SET funding_txid = NULL, funding_date = NULL, expiry = NULL")
+
+    def run(self, node, command):
+        self.prepare(command)
+        cmd = [sys.executable, os.path.join(dir_path, "zap_foil.py"), "-n", self.url, "-j", str(self.args.concurrency), \
+            "--node-rate", "0"] + self.command_args(command)
+        env = dict(os.environ, ZAP_FOIL_DB=f"sqlite:///{self.db_filename}")
+        log_filename = os.path.join(self.args.workdir, f"{command}_{self.size}.log")
+        requests = node.requests
+        start = time.time()
+        with open(log_filename, "w") as log:
+            # a new session has no controlling terminal, so getpass reads the seed from stdin
+            proc = subprocess.run(cmd, input=FUNDING_SEED + "\n", stdout=log, stderr=subprocess.STDOUT, \
+                env=env, universal_newlines=True, start_new_session=True)
+        wall = time.time() - start
+        requests = node.requests - requests
+        return {"size": self.size, "command": command, "wall": wall, "requests": requests, \
+            "rps": requests / wall if wall else 0, "exit": proc.returncode, "log": log_filename}
+
+def print_result(result, baseline):
+    line = f"{result['size']:>7} {result['command']:<24} {result['wall']:>9.2f}s {result['requests']:>9} {result['rps']:>9.1f}"
+    base = baseline.get((result["size"], result["command"]))
+    if base and base["wall"]:
+        line += f" {(result['wall'] - base['wall']) / base['wall'] * 100:>+8.1f}%"
+    if result["exit"]:
+        line += f"  (exit {result['exit']}, see {result['log']})"
+    print(line)
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help=f"The numbers of foils to benchmark with (default: {DEFAULT_SIZES})")
+    parser.add_argument("-c", "--commands", nargs="+", choices=COMMANDS, default=COMMANDS, help="The commands to run, in order (default: all)")
+    parser.add_argument("-j", "--concurrency", type=int, default=10, help="The concurrency passed to zap_foil.py (default: 10)")
+    parser.add_argument("-l", "--latency", type=float, default=0, help="Seconds the fake node waits before answering each request (default: 0)")
+    parser.add_argument("-e", "--error-rate", type=float, default=0, help="The fraction of node requests that fail with a 503 (default: 0)")
+    parser.add_argument("-t", "--throttle-rate", type=float, default=0, help="The fraction of node requests that are throttled with a 429 (default: 0)")
+    parser.add_argument("-w", "--workdir", default=os.path.join(dir_path, "benchmark"), help="The directory for scratch databases and logs (default: ./benchmark)")
+    parser.add_argument("-o", "--output", help="Write the results to this json file")
+    parser.add_argument("-b", "--baseline", help="Compare wall times with the results in this json file")
+    return parser
+
+if __name__ == "__main__":
+    args = construct_parser().parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = dict(((r["size"], r["command"]), r) for r in json.load(f))
+
+    pw.setOffline()
+    pw.setChain("testnet", "T")
+    sender = seed_address(FUNDING_SEED)
+    node = FakeNode(args.latency, args.error_rate, args.throttle_rate, [sender])
+    server = FakeNodeServer(node).start()
+    print(f"fake node at {server.url}, latency {args.latency}s, errors {args.error_rate}, throttled {args.throttle_rate}")
+
+    print(f"{'foils':>7} {'command':<24} {'wall':>10} {'requests':>9} {'req/s':>9}")
+    results = []
+    try:
+        for size in args.sizes:
+            bench = Bench(args, size, server.url, sender)
+            for command in args.commands:
+                result = bench.run(node, command)
+                print_result(result, baseline)
+                results.append(result)
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(result["exit"] for result in results):
+        sys.exit(1)
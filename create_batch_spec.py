@@ -1,64 +1,148 @@
 #!/usr/bin/env python3.7
 
-import sys
-import os
+# plan the funding of batches of foils: spread allocations over a range of batches into a batch spec of
+# (batch, amount) pairs, and work out the transfers, fees and totals needed to fund the foils of a spec that
+# are in the database, fund_multiple and check_multiple read the spec or the plan written here
+
+import argparse
 import json
+import sys
+
+from transactions import MASS_TRANSFER_MAX, mass_transfer_fee
+
+ZAP_CENTS = 100
+# each foil gets an extra cent to pay the fee of the transfer that spends it
+FOIL_FEE = 1
+# the fee of a single funding transfer, paid in the asset, when the asset's own minimum fee is not known
+TRANSFER_FEE = 1
+
+# (percent of the batches, zap per foil)
+DEFAULT_ALLOCATIONS = ((50, 5), (30, 10), (10, 15), (10, 20))
+DEFAULT_CLUMP_SIZE = 10
+
+def allocate(batch_start, batch_end, allocations=DEFAULT_ALLOCATIONS, clump_size=DEFAULT_CLUMP_SIZE):
+    # spread the allocations over the batches in repeating clumps of clump_size batches, returning
+    # (batch, amount in zap cents) pairs
+    clumps = []
+    for percent, value in allocations:
+        clumps += [value] * int(percent / 100.0 * clump_size)
+    if not clumps:
+        raise ValueError(f"no allocation gets a batch in a clump of {clump_size}")
+    return [(batch, clumps[i % len(clumps)] * ZAP_CENTS + FOIL_FEE) \
+        for i, batch in enumerate(range(batch_start, batch_end + 1))]
+
+class FundingPlan:
+    # the foils of each batch of a spec and the transfers that fund the ones without a funding transaction,
+    # counts is {batch: (foils, funded foils)}, fee is the asset fee of each single transfer
+    def __init__(self, batch_spec, counts, mass=False, fee=TRANSFER_FEE):
+        self.mass = mass
+        self.fee = fee
+        self.amounts = dict((batch, amount) for batch, amount in batch_spec)
+        # (batch, amount, foils, unfunded foils), in batch order like the foils are streamed
+        self.batches = []
+        for batch, amount in sorted(self.amounts.items()):
+            foils, funded = counts.get(batch, (0, 0))
+            self.batches.append((batch, amount, foils, foils - funded))
+        self.foils = sum(foils for batch, amount, foils, unfunded in self.batches)
+        self.unfunded = sum(unfunded for batch, amount, foils, unfunded in self.batches)
+        self.chunks = self._mass_chunks() if mass else []
+        # the asset needed, and the waves needed for mass transfer fees
+        self.required_funds = sum(amount * unfunded for batch, amount, foils, unfunded in self.batches)
+        if mass:
+            self.required_fee = sum(fee for size, amount, fee in self.chunks)
+        else:
+            self.required_funds += fee * self.unfunded
+            self.required_fee = 0
+
+    def _mass_chunks(self):
+        # (foils, amount, fee) of each mass transfer, they take the unfunded foils in batch order and cross
+        # batch boundaries
+        chunks = []
+        size = total = 0
+        for batch, amount, foils, unfunded in self.batches:
+            while unfunded:
+                count = min(unfunded, MASS_TRANSFER_MAX - size)
+                size += count
+                total += count * amount
+                unfunded -= count
+                if size == MASS_TRANSFER_MAX:
+                    chunks.append((size, total, mass_transfer_fee(size)))
+                    size = total = 0
+        if size:
+            chunks.append((size, total, mass_transfer_fee(size)))
+        return chunks
+
+    def spec(self):
+        return [(batch, amount) for batch, amount, foils, unfunded in self.batches]
+
+    def to_json(self):
+        return {
+            "mass": self.mass,
+            "fee": self.fee,
+            "batches": self.batches,
+            "chunks": self.chunks,
+            "foils": self.foils,
+            "unfunded": self.unfunded,
+            "required_funds": self.required_funds,
+            "required_fee": self.required_fee,
+        }
+
+    def print(self, file=sys.stdout):
+        for batch, amount, foils, unfunded in self.batches:
+            print(f" - batch {batch}: {amount} each, {unfunded} of {foils} foils to fund", file=file)
+        print(f"Foils to fund: {self.unfunded} of {self.foils}", file=file)
+        print(f"Required zap: {self.required_funds}", file=file)
+        if self.mass:
+            print(f"Required waves: {self.required_fee} for {len(self.chunks)} mass transfers", file=file)
+
+def plan_funding(session, batch_spec, mass=False, fee=TRANSFER_FEE):
+    # the plan of a spec, from one aggregate query over its batches
+    from models import Foil
+    return FundingPlan(batch_spec, Foil.funding_counts(session, [batch for batch, amount in batch_spec]), mass, fee)
+
+def read_spec(filename):
+    # the (batch, amount) pairs of a batch spec file, or of a plan written by this script
+    with open(filename, "r") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return [(batch, amount) for batch, amount, foils, unfunded in data["batches"]]
+    return [(batch, amount) for batch, amount in data]
+
+def _allocation(value):
+    # PERCENT:ZAP
+    percent, zap = value.split(":")
+    return int(percent), int(zap)
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("batch_start", metavar="BATCH_START", type=int, help="The first batch")
+    parser.add_argument("batch_end", metavar="BATCH_END", type=int, help="The last batch")
+    parser.add_argument("-a", "--allocation", type=_allocation, action="append", default=None, help="PERCENT:ZAP, the percent of batches with foils of ZAP each (can be repeated, default: 50:5 30:10 10:15 10:20)")
+    parser.add_argument("-c", "--clump-size", type=int, default=DEFAULT_CLUMP_SIZE, help=f"The number of batches the allocations are spread over before repeating (default: {DEFAULT_CLUMP_SIZE})")
+    parser.add_argument("-M", "--mass-transfer", action="store_true", help=f"Plan mass transfers of up to {MASS_TRANSFER_MAX} foils, with their waves fees (default: false)")
+    parser.add_argument("-f", "--fee", type=int, default=TRANSFER_FEE, help=f"The asset fee of each single funding transfer, the minSponsoredAssetFee of the asset (default: {TRANSFER_FEE})")
+    parser.add_argument("-o", "--output", default="batches.json", help="The batch spec file to write (default: batches.json)")
+    parser.add_argument("-p", "--plan", help="Also write the plan, with the foils, transfers and fees of each batch, to this json file")
+    return parser
+
+if __name__ == "__main__":
+    args = construct_parser().parse_args()
+    try:
+        batch_spec = allocate(args.batch_start, args.batch_end, args.allocation or DEFAULT_ALLOCATIONS, args.clump_size)
+    except ValueError as ex:
+        print(f"ERROR: {ex}")
+        sys.exit(1)
+
+    # the foils of the batches are counted in the database
+    from database import db_session, init_db
+    init_db()
+    plan = plan_funding(db_session, batch_spec, args.mass_transfer, args.fee)
+    plan.print()
 
-batch_start = 2000
-batch_end = 2199
-batch_size = 10
-zap_cents = 100
-
-clump_size = 10
-
-batch_allocations = (
-        (50, 5),
-        (30, 10),
-        (10, 15),
-        (10, 20))
-
-batch_count = batch_end - (batch_start - 1)
-
-print(f"batch count: {batch_count}\n")
-print("batch allocations:")
-batch_allocations_calc = []
-total_zap = 0
-for alloc in batch_allocations:
-    percent, value = alloc
-    num = int(percent/100.0 * batch_count)
-    total_value = value * num * batch_size
-    total_zap += total_value
-    batch_allocations_calc.append((percent, value, num, total_value))
-    print(f" - {percent}%, {value} ZAP, {num} batches, {total_value} ZAP total")
-
-print(f"\ntotal zap: {total_zap}\n")
-
-print(f"clump size: {clump_size}")
-clumps = []
-for alloc in batch_allocations_calc:
-    percent, value, num, total_value = alloc
-    num_per_clump = int(percent/100.0 * clump_size)
-    for i in range(num_per_clump):
-        clumps.append(value)
-    print(f" - {num_per_clump} at, {value} ZAP")
-
-batches = []
-current_batch = batch_start
-current_clump_index = 0
-while current_batch <= batch_end:
-    value = clumps[current_clump_index % len(clumps)]
-    value *= zap_cents # convert to zap cents
-    tx_fee = 1
-    batches.append((current_batch, value + tx_fee))
-    current_clump_index += 1
-    current_batch += 1
-total_zap = 0
-for batch_index, value in batches:
-    batch_zap = value/zap_cents * batch_size
-    total_zap += batch_zap
-print(f"\nCreated batches - total zap: {total_zap}\n")
-
-filename = "batches.json"
-with open(filename, "w") as f:
-    json.dump(batches, f, indent=4)
-print(f"Wrote batches to {filename}")
+    with open(args.output, "w") as f:
+        json.dump(batch_spec, f, indent=4)
+    print(f"Wrote batches to {args.output}")
+    if args.plan:
+        with open(args.plan, "w") as f:
+            json.dump(plan.to_json(), f, indent=4)
+        print(f"Wrote plan to {args.plan}")
@@ -1,19 +1,154 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text, UniqueConstraint
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.ext.declarative import declarative_base
 import os
+import sys
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
-engine = create_engine("sqlite:///%s/zap_foils.db" % dir_path, convert_unicode=True)
+# ZAP_FOIL_DB selects another database, like a scratch database for benchmarks or postgresql://user@host/zap_foils
+# to share one store between several machines
+database_url = os.environ.get("ZAP_FOIL_DB", "sqlite:///%s/zap_foils.db" % dir_path)
+
+# seconds to wait for a lock held by another process, or for a free pooled connection
+DEFAULT_DB_TIMEOUT = 30
+# connections kept open by a server database, and the number opened on top of them when all are busy
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_OVERFLOW = 10
+# seconds before a pooled connection is replaced, servers drop connections that are idle for too long
+POOL_RECYCLE = 1800
+
+engine = None
 db_session = scoped_session(sessionmaker(autocommit=False,
-                                         autoflush=False,
-                                         bind=engine))
+                                         autoflush=False))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
-def init_db():
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # with the write ahead log readers do not block the writer and the other way round, so several zap_foil
+    # processes can share the file, and synchronous=normal only syncs at checkpoints instead of on every commit,
+    # which the wal keeps safe against corruption
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def create_db_engine(url=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_DB_TIMEOUT):
+    url = make_url(url or database_url)
+    if url.get_backend_name() == "sqlite":
+        # writers wait for each other's locks instead of failing with "database is locked"
+        db_engine = create_engine(url, convert_unicode=True, connect_args={"timeout": timeout})
+        if url.database and url.database != ":memory:":
+            event.listen(db_engine, "connect", _sqlite_pragmas)
+        return db_engine
+    # a server database, the driver (like psycopg2 for postgresql) is only needed when it is used
+    return create_engine(url, convert_unicode=True, pool_size=pool_size, max_overflow=DEFAULT_POOL_OVERFLOW, \
+        pool_timeout=timeout, pool_recycle=POOL_RECYCLE, pool_pre_ping=True)
+
+def init_db(url=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_DB_TIMEOUT):
+    global engine
+    engine = create_db_engine(url, pool_size, timeout)
+    db_session.remove()
+    db_session.configure(bind=engine)
     # import all modules here that might define models so that
     # they will be registered properly on the metadata.  Otherwise
     # you will have to import them first before calling init_db()
     import models
     Base.metadata.create_all(bind=engine)
+    upgrade_db()
+
+def _unique_columns(constraints):
+    return set(tuple(sorted(c)) for c in constraints)
+
+def _relaxed_constraints(inspector, table):
+    # the unique constraints of the table that are no longer in the model
+    wanted = _unique_columns([col.name for col in c.columns] for c in table.constraints \
+        if isinstance(c, UniqueConstraint))
+    return [c for c in inspector.get_unique_constraints(table.name) \
+        if tuple(sorted(c["column_names"])) not in wanted]
+
+def _relaxed_not_null(inspector, table):
+    # the columns that are not null in the table but may be null in the model
+    return [col["name"] for col in inspector.get_columns(table.name) \
+        if not col["nullable"] and col["name"] in table.columns and table.columns[col["name"]].nullable \
+        and not table.columns[col["name"]].primary_key]
+
+def _dangling_foreign_keys(inspector, table):
+    # the foreign keys of the table that refer to a table that does not exist, older versions left the foreign
+    # keys of other tables pointing at the renamed copy of a table they rebuilt
+    tables = set(inspector.get_table_names())
+    return [fk for fk in inspector.get_foreign_keys(table.name) if fk["referred_table"] not in tables]
+
+def _rebuild_table(inspector, table):
+    # sqlite's documented way to change a table, the rows are copied to a new table that then replaces the old
+    # one, renaming the old table out of the way instead points the foreign keys of other tables at it
+    new = f"{table.name}_new"
+    columns = [col["name"] for col in inspector.get_columns(table.name) if col["name"] in table.columns]
+    columns = ", ".join(columns)
+    copy = table.tometadata(table.metadata, name=new)
+    try:
+        with engine.connect() as conn:
+            # foreign keys are only switched off outside a transaction, with them on dropping the old table
+            # would delete or fail on the rows that refer to it
+            foreign_keys = conn.execute(text("PRAGMA foreign_keys")).scalar()
+            conn.execute(text("PRAGMA foreign_keys=OFF"))
+            try:
+                with conn.begin():
+                    # pysqlite only begins a transaction before a change to rows, the new table would be created
+                    # outside of it and left behind if the copy is interrupted, as older versions did
+                    conn.execute(text("BEGIN"))
+                    conn.execute(text(f"DROP TABLE IF EXISTS {new}"))
+                    conn.execute(CreateTable(copy))
+                    conn.execute(text(f"INSERT INTO {new} ({columns}) SELECT {columns} FROM {table.name}"))
+                    # the indexes of the old table go with it
+                    conn.execute(text(f"DROP TABLE {table.name}"))
+                    conn.execute(text(f"ALTER TABLE {new} RENAME TO {table.name}"))
+                    for index in table.indexes:
+                        index.create(conn)
+            finally:
+                conn.execute(text(f"PRAGMA foreign_keys={'ON' if foreign_keys else 'OFF'}"))
+    finally:
+        table.metadata.remove(copy)
+
+def _add_column(table, column):
+    # only nullable columns can be added to a table that already has rows
+    column_type = column.type.compile(dialect=engine.dialect)
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+def upgrade_db():
+    # bring tables created by older versions up to date with the models
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        relaxed = _relaxed_constraints(inspector, table)
+        nullable = _relaxed_not_null(inspector, table)
+        if engine.dialect.name == "sqlite" and (relaxed or nullable or _dangling_foreign_keys(inspector, table)):
+            # sqlite cannot drop a constraint, the table has to be rebuilt
+            print(f"upgrading table '{table.name}'..", file=sys.stderr)
+            _rebuild_table(inspector, table)
+            inspector = inspect(engine)
+        elif relaxed or nullable:
+            with engine.begin() as conn:
+                for constraint in relaxed:
+                    print(f"dropping constraint '{table.name}.{constraint['name']}'..", file=sys.stderr)
+                    conn.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {constraint['name']}"))
+                for column in nullable:
+                    print(f"dropping not null of '{table.name}.{column}'..", file=sys.stderr)
+                    conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column} DROP NOT NULL"))
+            inspector = inspect(engine)
+        existing = set(col["name"] for col in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                print(f"adding column '{table.name}.{column.name}'..", file=sys.stderr)
+                _add_column(table, column)
+        # create_all only creates indexes along with new tables, and never drops the ones replaced in the model
+        existing = set(index["name"] for index in inspector.get_indexes(table.name))
+        wanted = set(index.name for index in table.indexes)
+        for name in existing - wanted:
+            if name.startswith("ix_"):
+                with engine.begin() as conn:
+                    conn.execute(text(f"DROP INDEX {name}"))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
@@ -0,0 +1,128 @@
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+FORMAT_PARQUET = "parquet"
+FORMATS = (FORMAT_CSV, FORMAT_JSONL, FORMAT_PARQUET)
+
+# rows are written to parquet in row groups of this many rows
+PARQUET_ROW_GROUP = 100000
+# seconds between progress reports
+PROGRESS_INTERVAL = 2
+WRITE_BUFFER = 1024 * 1024
+
+class Progress:
+    # report the number of rows written at most once per interval, on stderr so stdout can carry the export
+    def __init__(self, interval=PROGRESS_INTERVAL, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.count = 0
+        self.start = time.monotonic()
+        self.next = self.start + interval
+
+    def update(self, count=1):
+        self.count += count
+        now = time.monotonic()
+        if now >= self.next:
+            self.next = now + self.interval
+            self._report(now)
+
+    def done(self):
+        self._report(time.monotonic())
+
+    def _report(self, now):
+        elapsed = now - self.start
+        rate = self.count / elapsed if elapsed else 0
+        self.stream.write(f"{self.count} rows in {elapsed:.1f}s ({rate:.0f} rows/s)\n")
+        self.stream.flush()
+
+def format_from_path(path):
+    # guess the format from the file name, like codes.jsonl.gz
+    name = path[:-3] if path.endswith(".gz") else path
+    for fmt in FORMATS:
+        if name.endswith(f".{fmt}"):
+            return fmt
+    return FORMAT_CSV
+
+def _open_text(path, compress):
+    # a buffered text stream for path, "-" is stdout
+    if path == "-":
+        if compress:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb"), newline="")
+        return io.TextIOWrapper(sys.stdout.buffer, newline="", write_through=False)
+    if compress:
+        return gzip.open(path, "wt", newline="")
+    return open(path, "w", newline="", buffering=WRITE_BUFFER)
+
+def _write_csv(f, columns, rows, progress):
+    # strings are always quoted, so seeds and other text survive spreadsheet imports intact
+    writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        progress.update()
+
+def _write_jsonl(f, columns, rows, progress):
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+    for row in rows:
+        f.write(encode(dict(zip(columns, row))))
+        f.write("\n")
+        progress.update()
+
+def _write_parquet(path, columns, types, rows, progress, compress):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("parquet export needs pyarrow (pip install pyarrow)")
+    if path == "-":
+        path = sys.stdout.buffer
+    # the schema comes from the column types, a row group of nulls must not decide a column's type
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    schema = pa.schema([(column, arrow_types[t]) for column, t in zip(columns, types)])
+    writer = pq.ParquetWriter(path, schema, compression="gzip" if compress else "snappy")
+    try:
+        while True:
+            group = []
+            for row in rows:
+                group.append(row)
+                if len(group) >= PARQUET_ROW_GROUP:
+                    break
+            if not group:
+                break
+            arrays = [pa.array(list(values), type=field.type) for values, field in zip(zip(*group), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            progress.update(len(group))
+    finally:
+        writer.close()
+
+def export_rows(path, fmt, columns, types, rows, compress=False, progress=None):
+    # stream rows (tuples in the order of columns, of int, float or str types) to path in the given format,
+    # returns the number of rows
+    progress = progress or Progress()
+    rows = iter(rows)
+    if fmt == FORMAT_PARQUET:
+        _write_parquet(path, columns, types, rows, progress, compress)
+    else:
+        f = _open_text(path, compress)
+        try:
+            if fmt == FORMAT_JSONL:
+                _write_jsonl(f, columns, rows, progress)
+            else:
+                _write_csv(f, columns, rows, progress)
+        finally:
+            if path == "-":
+                f.flush()
+                if compress:
+                    f.close()
+                else:
+                    f.detach()
+            else:
+                f.close()
+    progress.done()
+    return progress.count
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3.7
+
+# a local stand-in for the waves node endpoints zap_foil.py uses, for benchmarks and offline runs
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from transactions import txid, transfer_bytes, mass_transfer_bytes, TRANSFER_API, BROADCAST_API
+
+DEFAULT_PORT = 6869
+DEFAULT_WAVES_BALANCE = 10 ** 12
+# the default minSponsoredAssetFee of an asset
+DEFAULT_ASSET_FEE = 1
+
+class FakeNode:
+    # node state, shared by all request handler threads
+    def __init__(self, latency=0, error_rate=0, throttle_rate=0, rich=(), asset_fee=DEFAULT_ASSET_FEE):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rich = set(rich)
+        self.asset_fee = asset_fee
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.transactions = {}
+        self.address_transactions = {}
+        self.requests = 0
+        self.errors = 0
+
+    def balance(self, address, assetid):
+        if address in self.rich:
+            return DEFAULT_WAVES_BALANCE
+        return self.balances.get((address, assetid), 0)
+
+    def _add_transaction(self, tx, recipients):
+        with self.lock:
+            self.transactions[tx["id"]] = tx
+            for recipient, amount in recipients:
+                key = (recipient, tx["assetId"])
+                self.balances[key] = self.balances.get(key, 0) + amount
+                self.address_transactions.setdefault(recipient, []).append(tx)
+
+    def broadcast(self, api, tx):
+        # accept a signed transfer or mass transfer, crediting the recipients straight away
+        if api == TRANSFER_API:
+            sdata = transfer_bytes(tx["senderPublicKey"], tx["recipient"], tx["assetId"], tx["amount"], tx["fee"], \
+                tx["feeAssetId"], tx["timestamp"])
+            tx = dict(tx, type=4)
+            recipients = [(tx["recipient"], tx["amount"])]
+        elif api == BROADCAST_API and tx.get("type") == 11:
+            sdata = mass_transfer_bytes(tx["senderPublicKey"], tx["transfers"], tx["assetId"], tx["fee"], tx["timestamp"])
+            recipients = [(t["recipient"], t["amount"]) for t in tx["transfers"]]
+        else:
+            return 400, {"error": 1, "message": "unsupported transaction"}
+        tx["id"] = txid(sdata)
+        tx["height"] = self.height()
+        if tx["id"] in self.transactions:
+            return 400, {"error": 112, "message": f"Transaction {tx['id']} is already in the state"}
+        self._add_transaction(tx, recipients)
+        return 200, tx
+
+    def history(self, address, limit, after):
+        # newest first, like the node
+        txs = list(reversed(self.address_transactions.get(address, [])))
+        if after:
+            ids = [tx["id"] for tx in txs]
+            txs = txs[ids.index(after) + 1:] if after in ids else []
+        return [txs[:limit]]
+
+    def statuses(self, ids):
+        result = []
+        for id in ids:
+            tx = self.transactions.get(id)
+            if tx:
+                result.append({"id": id, "status": "confirmed", "height": tx["height"], "confirmations": 0})
+            else:
+                result.append({"id": id, "status": "not_found"})
+        return result
+
+    def height(self):
+        return 1000 + len(self.transactions)
+
+    def get(self, path, query):
+        m = re.match(r"^/assets/balance/(\w+)/(\w+)$", path)
+        if m:
+            return 200, {"address": m.group(1), "assetId": m.group(2), "balance": self.balance(m.group(1), m.group(2))}
+        m = re.match(r"^/addresses/balance/(\w+)$", path)
+        if m:
+            return 200, {"address": m.group(1), "confirmations": 0, "balance": self.balance(m.group(1), None)}
+        m = re.match(r"^/assets/details/(\w+)$", path)
+        if m:
+            return 200, {"assetId": m.group(1), "name": "ZAP", "decimals": 2, "minSponsoredAssetFee": self.asset_fee}
+        m = re.match(r"^/transactions/address/(\w+)/limit/(\d+)$", path)
+        if m:
+            return 200, self.history(m.group(1), int(m.group(2)), query.get("after", [None])[0])
+        m = re.match(r"^/transactions/info/(\w+)$", path)
+        if m:
+            if m.group(1) in self.transactions:
+                return 200, self.transactions[m.group(1)]
+            return 404, {"error": 311, "message": "transactions does not exist"}
+        if path == "/blocks/height":
+            return 200, {"height": self.height()}
+        m = re.match(r"^/alias/by-address/(\w+)$", path)
+        if m:
+            return 200, []
+        return 404, {"error": 1, "message": f"not found: {path}"}
+
+    def post(self, path, payload):
+        if path == "/transactions/status":
+            return 200, self.statuses(payload["ids"])
+        if path in (TRANSFER_API, BROADCAST_API):
+            return self.broadcast(path, payload)
+        return 404, {"error": 1, "message": f"not found: {path}"}
+
+    def inject(self):
+        # the status of an injected failure, if this request should fail
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            return 429
+        if self.error_rate and random.random() < self.error_rate:
+            return 503
+        return None
+
+def _handler(node):
+    class Handler(BaseHTTPRequestHandler):
+        # http/1.1 so clients can keep connections alive
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body, headers={}):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self, fn):
+            with node.lock:
+                node.requests += 1
+            if node.latency:
+                time.sleep(node.latency)
+            status = node.inject()
+            if status:
+                with node.lock:
+                    node.errors += 1
+                self._reply(status, {"error": status, "message": "injected failure"}, {"retry-after": "0"})
+                return
+            status, body = fn()
+            self._reply(status, body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            self._handle(lambda: node.get(url.path, parse_qs(url.query)))
+
+        def do_POST(self):
+            length = int(self.headers.get("content-length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            self._handle(lambda: node.post(urlsplit(self.path).path, payload))
+
+    return Handler
+
+class FakeNodeServer:
+    # serve a FakeNode on a background thread
+    def __init__(self, node, port=0):
+        self.node = node
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _handler(node))
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def construct_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help=f"The port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("-l", "--latency", type=float, default=0, help="Seconds to wait before answering each request (default: 0)")
+    parser.add_argument("-e", "--error-rate", type=float, default=0, help="The fraction of requests that fail with a 503 (default: 0)")
+    parser.add_argument("-t", "--throttle-rate", type=float, default=0, help="The fraction of requests that are throttled with a 429 (default: 0)")
+    parser.add_argument("-r", "--rich", action="append", default=[], help="An address with an unlimited balance, like the funding account (can be repeated)")
+    return parser
+
+if __name__ == "__main__":
+    args = construct_parser().parse_args()
+    node = FakeNode(args.latency, args.error_rate, args.throttle_rate, args.rich)
+    server = FakeNodeServer(node, args.port)
+    print(f"fake node listening on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILENAME = "manifest.json"
+CACHE_DIRNAME = "cache"
+MANIFEST_VERSION = 2
+
+def fingerprint(*values):
+    # a stable hash of json serialisable values
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+def foil_hash(layout_fingerprint, batch, seed):
+    # the page of a foil only depends on its batch, its seed and the layout
+    return hashlib.sha256(f"{layout_fingerprint}:{batch}:{seed}".encode()).hexdigest()
+
+class ImageCache:
+    # rendered pages stored by the hash of what they show, and a manifest of the batches and pdfs that are up to
+    # date, so only new or changed foils are rendered again, reuse=False renders everything again
+    # the manifest holds one entry per batch rather than per foil, so it stays small and a batch whose foils
+    # have not changed is skipped without reading them
+    def __init__(self, path, reuse=True):
+        self.path = path
+        self.reuse = reuse
+        self.cache_path = os.path.join(path, CACHE_DIRNAME)
+        self.manifest_filename = os.path.join(path, MANIFEST_FILENAME)
+        self.batches = {}
+        self.pdfs = {}
+        if reuse and os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.batches = manifest["batches"]
+                self.pdfs = manifest["pdfs"]
+
+    def png_filename(self, hash):
+        return os.path.join(self.cache_path, hash[:2], f"{hash}.png")
+
+    def has_png(self, hash):
+        return self.reuse and os.path.exists(self.png_filename(hash))
+
+    def read_png(self, hash):
+        with open(self.png_filename(hash), "rb") as f:
+            return f.read()
+
+    def write_png(self, hash, png):
+        filename = self.png_filename(hash)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = f"{filename}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, filename)
+
+    def batch_digest(self, batch, summary, layout_fingerprint):
+        # the digest of the pages of a batch recorded when it had the same summary, (max id, foils), and layout,
+        # None when the batch changed since or was never rendered
+        entry = self.batches.get(str(batch))
+        if entry and entry["summary"] == list(summary) and entry["layout"] == layout_fingerprint:
+            return entry["digest"]
+        return None
+
+    def set_batch(self, batch, summary, layout_fingerprint, digest):
+        self.batches[str(batch)] = {"summary": list(summary), "layout": layout_fingerprint, "digest": digest}
+
+    def pdf_current(self, filename, hash):
+        return self.pdfs.get(os.path.basename(filename)) == hash and os.path.exists(filename)
+
+    def set_pdf(self, filename, hash):
+        self.pdfs[os.path.basename(filename)] = hash
+
+    def save(self):
+        # replace the manifest in one step, an interrupted run leaves the previous one
+        tmp = f"{self.manifest_filename}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "batches": self.batches, "pdfs": self.pdfs}, f, \
+                separators=(",", ":"))
+        os.replace(tmp, self.manifest_filename)
@@ -0,0 +1,127 @@
+import json
+
+from models import Foil, FoilTransfer, IndexedBlock
+
+# the node returns at most this many blocks per request
+BLOCKS_PER_REQUEST = 100
+# the number of recent blocks that are rechecked for a rollback on every run
+DEFAULT_ROLLBACK_DEPTH = 10
+
+TRANSFER_TX = 4
+MASS_TRANSFER_TX = 11
+
+def block_id(block):
+    return block.get("id") or block["signature"]
+
+class NodeBlockSource:
+    def __init__(self, client):
+        self.client = client
+
+    def height(self):
+        return self.client.get("/blocks/height")["height"]
+
+    def blocks(self, start, end):
+        return self.client.get(f"/blocks/seq/{start}/{end}")
+
+    def headers(self, start, end):
+        return self.client.get(f"/blocks/headers/seq/{start}/{end}")
+
+class FixtureBlockSource:
+    # blocks recorded from /blocks/seq in a json list, for running the indexer offline
+    def __init__(self, filename):
+        with open(filename, "r") as f:
+            self._blocks = dict((block["height"], block) for block in json.load(f))
+
+    def height(self):
+        return max(self._blocks) if self._blocks else 0
+
+    def blocks(self, start, end):
+        return [self._blocks[height] for height in range(start, end + 1) if height in self._blocks]
+
+    def headers(self, start, end):
+        return [dict((k, v) for k, v in block.items() if k != "transactions") for block in self.blocks(start, end)]
+
+def _transfers(tx, assetid):
+    # yield (sender, recipient, amount, fee paid in the asset) for each transfer of the asset in tx
+    if tx.get("assetId") != assetid:
+        return
+    fee = tx["fee"] if tx.get("feeAssetId") == assetid else 0
+    if tx["type"] == TRANSFER_TX:
+        yield tx["sender"], tx["recipient"], tx["amount"], fee
+    elif tx["type"] == MASS_TRANSFER_TX:
+        for transfer in tx["transfers"]:
+            yield tx["sender"], transfer["recipient"], transfer["amount"], fee
+            # the mass transfer fee is only paid once
+            fee = 0
+
+class Indexer:
+    def __init__(self, session, source, assetid, rollback_depth=DEFAULT_ROLLBACK_DEPTH):
+        self.session = session
+        self.source = source
+        self.assetid = assetid
+        self.rollback_depth = rollback_depth
+
+    def _rollback(self):
+        # compare the recent blocks we indexed with the chain and drop everything from the first that changed
+        last = IndexedBlock.last(self.session)
+        if not last:
+            return None
+        start = max(1, last.height - self.rollback_depth + 1)
+        indexed = IndexedBlock.from_height(self.session, start)
+        chain = dict((header["height"], block_id(header)) for header in self.source.headers(start, last.height))
+        for block in indexed:
+            if chain.get(block.height) != block.block_id:
+                height = block.height
+                print(f"rollback detected at height {height}")
+                FoilTransfer.delete_from_height(self.session, height)
+                IndexedBlock.delete_from_height(self.session, height)
+                self.session.commit()
+                return height - 1
+        return last.height
+
+    def _index_blocks(self, blocks):
+        # find the transfers touching foil addresses with one address lookup for the whole page of blocks
+        transfers = []
+        addresses = set()
+        for block in blocks:
+            for tx in block.get("transactions", []):
+                for sender, recipient, amount, fee in _transfers(tx, self.assetid):
+                    transfers.append((block, tx, sender, recipient, amount, fee))
+                    addresses.add(sender)
+                    addresses.add(recipient)
+        foil_ids = Foil.ids_from_addresses(self.session, addresses)
+
+        count = 0
+        for block, tx, sender, recipient, amount, fee in transfers:
+            timestamp = int(tx["timestamp"] / 1000)
+            if recipient in foil_ids:
+                self.session.add(FoilTransfer(foil_ids[recipient], tx["id"], block["height"], timestamp, \
+                    FoilTransfer.DIRECTION_IN, amount, 0))
+                count += 1
+            if sender in foil_ids:
+                self.session.add(FoilTransfer(foil_ids[sender], tx["id"], block["height"], timestamp, \
+                    FoilTransfer.DIRECTION_OUT, amount, fee))
+                count += 1
+        for block in blocks:
+            self.session.add(IndexedBlock(block["height"], block_id(block)))
+        return count
+
+    def run(self, start_height=1):
+        # index from the last processed height up to the current height, returns the number of transfers found
+        last = self._rollback()
+        height = last + 1 if last is not None else start_height
+        end = self.source.height()
+        count = 0
+        while height <= end:
+            batch_end = min(end, height + BLOCKS_PER_REQUEST - 1)
+            blocks = self.source.blocks(height, batch_end)
+            if not blocks:
+                break
+            count += self._index_blocks(blocks)
+            last_height = blocks[-1]["height"]
+            self.session.flush()
+            IndexedBlock.prune_below(self.session, last_height - self.rollback_depth + 1)
+            self.session.commit()
+            print(f"indexed blocks {height} - {last_height} ({count} transfers)")
+            height = last_height + 1
+        return count
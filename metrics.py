@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = "zap_foil"
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_json(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(BUCKETS) + ["+Inf"], self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"count": self.count, "sum": self.sum, "min": self.min, "max": self.max, \
+            "mean": self.sum / self.count if self.count else None, "buckets": buckets}
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+class Metrics:
+    # counters, gauges and latency histograms, safe to update from worker threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_json(self):
+        def entries(metrics, value):
+            return [dict(name=name, labels=dict(labels), **value(metric)) for (name, labels), metric in sorted(metrics.items())]
+        with self.lock:
+            return {
+                "counters": entries(self.counters, lambda v: {"value": v}),
+                "gauges": entries(self.gauges, lambda v: {"value": v}),
+                "histograms": entries(self.histograms, lambda h: h.to_json()),
+            }
+
+    def to_prometheus(self):
+        # the text exposition format, for the node exporter's textfile collector
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{PREFIX}_{name}_total{_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{PREFIX}_{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{PREFIX}_{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{PREFIX}_{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}_{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        # prometheus text for .prom files, json otherwise
+        with open(filename, "w") as f:
+            if filename.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=2)
+
+    def instrument_session(self, session):
+        # time every commit of a (scoped) session, including the flush it triggers
+        from sqlalchemy import event
+
+        def before_commit(s):
+            s.info["commit_start"] = time.perf_counter()
+
+        def after_commit(s):
+            start = s.info.pop("commit_start", None)
+            if start is not None:
+                self.observe("db_commit_seconds", time.perf_counter() - start)
+
+        event.listen(session, "before_commit", before_commit)
+        event.listen(session, "after_commit", after_commit)
+
+# the metrics of this process
+METRICS = Metrics()
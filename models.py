@@ -1,35 +1,96 @@
 import time
+import functools
+import json
 
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Text, Index, LargeBinary
 import sqlalchemy.types as types
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import func
-from sqlalchemy import or_, and_, desc
-from marshmallow import Schema, fields
+from sqlalchemy import or_, and_, not_, desc, case, select
 
 from database import Base
+from seeds import foil_seed
 
-class FoilSchema(Schema):
-    date = fields.Integer()
-    batch = fields.Integer()
-    seed = fields.String()
-    amount = fields.Integer()
-    funding_txid = fields.String()
-    funding_date = fields.Integer()
-    expiry = fields.Integer()
+# the number of rows the streaming queries load at a time
+STREAM_CHUNK_SIZE = 1000
+
+# the fields of a foil in json, and the type each value is converted to
+FOIL_FIELDS = (
+    ("date", int),
+    ("batch", int),
+    ("seed", str),
+    ("amount", int),
+    ("funding_txid", str),
+    ("funding_date", int),
+    ("expiry", int),
+    ("address", str),
+    ("funding_status", str),
+    ("funding_height", int),
+    ("swept", int),
+)
+FOIL_FIELD_NAMES = tuple(name for name, convert in FOIL_FIELDS)
+
+@functools.lru_cache(maxsize=None)
+def foil_serializer(fields=FOIL_FIELD_NAMES):
+    # a function turning a row of the given fields into a json dict, the conversions are looked up once here
+    # instead of for every row
+    conversions = dict(FOIL_FIELDS)
+    converters = tuple((name, conversions[name]) for name in fields)
+
+    def serialize(row):
+        return {name: None if value is None else convert(value) for (name, convert), value in zip(converters, row)}
+
+    return serialize
+
+@functools.lru_cache(maxsize=None)
+def foil_json_line(fields=FOIL_FIELD_NAMES):
+    # a function turning a row of the given fields into a compact line of json, the dict from foil_serializer
+    # encoded by one encoder made here instead of for every row
+    serialize = foil_serializer(fields)
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def json_line(row):
+        return encode(serialize(row))
+
+    return json_line
 
 class Foil(Base):
     __tablename__ = 'foils'
     id = Column(Integer, primary_key=True)
     date = Column(Integer, nullable=False)
     batch = Column(Integer, nullable=False)
-    seed = Column(String, nullable=False, unique=True)
+    # the mnemonic, or for a compacted foil only its 16 bytes of bip39 entropy in seed_entropy
+    seed = Column(String, nullable=True, unique=True)
+    seed_entropy = Column(LargeBinary, nullable=True)
     amount = Column(Integer, nullable=True)
-    funding_txid = Column(String, nullable=True, unique=True)
+    # not unique, a mass transfer funds many foils with one transaction
+    funding_txid = Column(String, nullable=True)
     funding_date = Column(Integer, nullable=True)
     expiry = Column(Integer, nullable=True)
+    address = Column(String, nullable=True, index=True)
+    funding_status = Column(String, nullable=True, index=True)
+    funding_height = Column(Integer, nullable=True)
+    # when the balance left on an expired foil was swept, or found to be empty
+    swept = Column(Integer, nullable=True)
 
-    def __init__(self, date, batch, seed, amount, funding_txid, funding_date, expiry):
+    __table_args__ = (
+        # batch ranges are read in (batch, id) order by the streaming queries
+        Index("ix_foils_batch_id", "batch", "id"),
+        Index("ix_foils_expiry_batch", "expiry", "batch"),
+        Index("ix_foils_funding_txid_status", "funding_txid", "funding_status"),
+        # expired foils waiting to be swept are found without scanning the foils already swept
+        Index("ix_foils_swept_expiry", "swept", "expiry"),
+        # an index rather than a column constraint, so it is created when the column is added to an old table
+        Index("ix_foils_seed_entropy", "seed_entropy", unique=True),
+    )
+
+    FUNDING_CONFIRMED = "confirmed"
+    FUNDING_UNCONFIRMED = "unconfirmed"
+    # not found by the node once, dropped when it is still not found on a later check
+    FUNDING_NOT_FOUND = "not_found"
+    FUNDING_DROPPED = "dropped"
+
+    def __init__(self, date, batch, seed, amount, funding_txid, funding_date, expiry, address=None):
         self.date = date
         self.batch = batch
         self.seed = seed
@@ -37,11 +98,195 @@ class Foil(Base):
         self.funding_txid = funding_txid
         self.funding_date = funding_date
         self.expiry = expiry
+        self.address = address
+
+    @property
+    def stored_seed(self):
+        # the seed as stored, a mnemonic or its entropy, for the address helpers to turn into a mnemonic when needed
+        return self.seed if self.seed is not None else self.seed_entropy
+
+    @property
+    def mnemonic(self):
+        return foil_seed(self.seed, self.seed_entropy)
+
+    @property
+    def funded(self):
+        # a foil whose funding transaction was dropped keeps its txid but can be funded again
+        return self.funding_txid is not None and self.funding_status != self.FUNDING_DROPPED
+
+    @classmethod
+    def funding_update(cls, foil_id, txid, date, expiry, amount):
+        # the mapping bulk_update_mappings records a funding with, a new funding is confirmed afresh and the foil is
+        # swept again when it expires
+        return {"id": foil_id, "funding_txid": txid, "funding_date": date, "expiry": expiry, "amount": amount, \
+            "funding_status": None, "funding_height": None, "swept": None}
 
     @classmethod
     def from_txid(cls, session, funding_txid):
         return session.query(cls).filter(cls.funding_txid == funding_txid).first()
 
+    @classmethod
+    def ids_from_addresses(cls, session, addresses):
+        # map the given addresses to foil ids, missing addresses are left out
+        result = {}
+        addresses = list(addresses)
+        for i in range(0, len(addresses), 500):
+            chunk = addresses[i:i + 500]
+            for foil_id, address in session.query(cls.id, cls.address).filter(cls.address.in_(chunk)):
+                result[address] = foil_id
+        return result
+
+    @classmethod
+    def _funded_criterion(cls):
+        return and_(cls.funding_txid != None, \
+            or_(cls.funding_status == None, cls.funding_status != cls.FUNDING_DROPPED))
+
+    @classmethod
+    def _unconfirmed_criterion(cls):
+        # foils with a funding transaction that has not been seen in a block yet
+        return and_(cls.funding_txid != None, \
+            or_(cls.funding_status == None, cls.funding_status != cls.FUNDING_CONFIRMED))
+
+    @classmethod
+    def _page_criterion(cls, last, criterion):
+        # rows after the (batch, id) key last that match criterion, sqlite seeks the index with the first lower
+        # bound on batch it finds, so that is the plain bound of the key, with only the or (or the bound of a
+        # batch range first) it scans the index from the start for every page
+        clauses = []
+        if last:
+            clauses += [cls.batch >= last[0], or_(cls.batch > last[0], and_(cls.batch == last[0], cls.id > last[1]))]
+        if criterion is not None:
+            clauses.append(criterion)
+        return and_(*clauses) if clauses else None
+
+    @classmethod
+    def _pages(cls, fetch, chunk_size, key):
+        # keyset pagination in (batch, id) order, so only a page of rows is loaded at a time however big the
+        # table is, and rows updated between pages are neither skipped nor repeated, fetch(last) returns up to
+        # chunk_size rows in (batch, id) order after the key last (None for the first page)
+        last = None
+        while True:
+            page = fetch(last)
+            if not page:
+                break
+            last = key(page[-1])
+            yield page
+            if len(page) < chunk_size:
+                break
+
+    @classmethod
+    def _stream(cls, session, criterion=None, chunk_size=STREAM_CHUNK_SIZE):
+        def fetch(last):
+            query = session.query(cls)
+            page_criterion = cls._page_criterion(last, criterion)
+            if page_criterion is not None:
+                query = query.filter(page_criterion)
+            return query.order_by(cls.batch, cls.id).limit(chunk_size).all()
+
+        for page in cls._pages(fetch, chunk_size, lambda foil: (foil.batch, foil.id)):
+            yield from page
+
+    @classmethod
+    def iter_rows(cls, session, columns, criterion=None, chunk_size=STREAM_CHUNK_SIZE):
+        # stream tuples of just the given columns, without building orm objects
+        for page in cls.iter_row_pages(session, columns, criterion, chunk_size):
+            yield from page
+
+    @classmethod
+    def iter_row_pages(cls, session, columns, criterion=None, chunk_size=STREAM_CHUNK_SIZE):
+        # stream lists of up to chunk_size tuples of the given columns, with core selects so no orm objects or
+        # orm rows are built
+        # labelled, a core select would drop a column selected twice, like batch
+        query = select([cls.batch, cls.id] + [column.label(f"c{i}") for i, column in enumerate(columns)])
+
+        def fetch(last):
+            page_criterion = cls._page_criterion(last, criterion)
+            page_query = query.where(page_criterion) if page_criterion is not None else query
+            return session.execute(page_query.order_by(cls.batch, cls.id).limit(chunk_size)).fetchall()
+
+        for page in cls._pages(fetch, chunk_size, lambda row: (row[0], row[1])):
+            yield [tuple(row)[2:] for row in page]
+
+    @classmethod
+    def criterion(cls, batch_start=None, batch_end=None, funded=None, expired=None, amount=None):
+        # a filter for a batch range, whether foils have been funded or have expired, and their amount, any of
+        # them may be None
+        clauses = []
+        if batch_start is not None:
+            clauses.append(cls.batch >= batch_start)
+        if batch_end is not None:
+            clauses.append(cls.batch <= batch_end)
+        if funded is not None:
+            clauses.append(cls._funded_criterion() if funded else not_(cls._funded_criterion()))
+        if expired is not None:
+            now = time.time()
+            clauses.append(cls.expiry <= now if expired else or_(cls.expiry == None, cls.expiry > now))
+        if amount is not None:
+            clauses.append(cls.amount == amount)
+        return and_(*clauses) if clauses else None
+
+    @classmethod
+    def iter_all(cls, session, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, None, chunk_size)
+
+    @classmethod
+    def iter_batch(cls, session, batch, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, cls.batch == batch, chunk_size)
+
+    @classmethod
+    def iter_batches(cls, session, batches, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, cls.batch.in_(list(batches)), chunk_size)
+
+    @classmethod
+    def iter_batches_starting_at(cls, session, batch, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, cls.batch >= batch, chunk_size)
+
+    @classmethod
+    def iter_batches_between(cls, session, batch_start, batch_end, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, and_(cls.batch >= batch_start, cls.batch <= batch_end), chunk_size)
+
+    @classmethod
+    def iter_missing_address(cls, session, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, cls.address == None, chunk_size)
+
+    @classmethod
+    def iter_unconfirmed(cls, session, chunk_size=STREAM_CHUNK_SIZE):
+        return cls._stream(session, cls._unconfirmed_criterion(), chunk_size)
+
+    @classmethod
+    def due_for_sweep(cls, session, date, after=None, limit=STREAM_CHUNK_SIZE):
+        # funded foils that expired by date and have not been swept, in (expiry, id) order after the key after
+        query = session.query(cls).filter(and_(cls.swept == None, cls.expiry <= date, cls._funded_criterion()))
+        if after:
+            query = query.filter(or_(cls.expiry > after[0], and_(cls.expiry == after[0], cls.id > after[1])))
+        return query.order_by(cls.expiry, cls.id).limit(limit).all()
+
+    @classmethod
+    def mark_swept(cls, session, foil_ids, date):
+        foil_ids = list(foil_ids)
+        for i in range(0, len(foil_ids), 500):
+            chunk = foil_ids[i:i + 500]
+            session.query(cls).filter(cls.id.in_(chunk)).update({cls.swept: date}, synchronize_session=False)
+
+    @classmethod
+    def funding_counts(cls, session, batches):
+        # {batch: (foils, funded foils)} for the batches, in one grouped query
+        query = session.query(cls.batch, func.count(cls.id), func.count(case([(cls._funded_criterion(), 1)]))) \
+            .filter(cls.batch.in_(list(batches))).group_by(cls.batch)
+        return dict((batch, (foils, funded)) for batch, foils, funded in query)
+
+    @classmethod
+    def batch_summaries(cls, session, criterion=None):
+        # {batch: (highest foil id, foils)} in one grouped query, read from the (batch, id) index alone
+        query = session.query(cls.batch, func.max(cls.id), func.count(cls.id))
+        if criterion is not None:
+            query = query.filter(criterion)
+        return dict((batch, (max_id, foils)) for batch, max_id, foils in query.group_by(cls.batch))
+
+    @classmethod
+    def count_missing_address(cls, session):
+        return session.query(func.count(cls.id)).filter(cls.address == None).scalar()
+
     @classmethod
     def all(cls, session):
         return session.query(cls).all()
@@ -60,13 +305,16 @@ class Foil(Base):
 
     @classmethod
     def next_batch_id(cls, session):
-        batch = 1000
-        while True:
-            foils = cls.get_batch(session, batch)
-            if not foils:
-                break
-            batch += 1
-        return batch
+        batch = session.query(func.max(cls.batch)).scalar()
+        if batch is None or batch < 1000:
+            return 1000
+        return batch + 1
+
+    @classmethod
+    def insert_many(cls, session, rows):
+        # insert plain dicts with a single executemany, skipping the orm unit of work
+        if rows:
+            session.execute(cls.__table__.insert(), rows)
 
     @classmethod
     def count(cls, session):
@@ -76,5 +324,161 @@ class Foil(Base):
         return '<Foil %r>' % (self.funding_txid)
 
     def to_json(self):
-        foil_schema = FoilSchema()
-        return foil_schema.dump(self).data
+        return foil_serializer()(tuple(self.mnemonic if name == "seed" else getattr(self, name) for name in FOIL_FIELD_NAMES))
+
+class FoilTransfer(Base):
+    # transfers of the asset to (funding) or from (redemption) a foil address, recorded by the indexer
+    __tablename__ = 'foil_transfers'
+    id = Column(Integer, primary_key=True)
+    foil_id = Column(Integer, ForeignKey('foils.id'), nullable=False, index=True)
+    txid = Column(String, nullable=False, index=True)
+    height = Column(Integer, nullable=False, index=True)
+    timestamp = Column(Integer, nullable=False)
+    direction = Column(String, nullable=False)
+    amount = Column(Integer, nullable=False)
+    fee = Column(Integer, nullable=False)
+
+    DIRECTION_IN = "in"
+    DIRECTION_OUT = "out"
+
+    def __init__(self, foil_id, txid, height, timestamp, direction, amount, fee):
+        self.foil_id = foil_id
+        self.txid = txid
+        self.height = height
+        self.timestamp = timestamp
+        self.direction = direction
+        self.amount = amount
+        self.fee = fee
+
+    @classmethod
+    def delete_from_height(cls, session, height):
+        session.query(cls).filter(cls.height >= height).delete(synchronize_session=False)
+
+    @classmethod
+    def balances(cls, session, foil_ids):
+        # the indexed balance of each foil, the sender of a transfer also pays the fee when it is in the asset
+        balance = func.sum(case([(cls.direction == cls.DIRECTION_IN, cls.amount)], else_=-(cls.amount + cls.fee)))
+        redeemed = func.max(case([(cls.direction == cls.DIRECTION_OUT, cls.txid)], else_=None))
+        result = {}
+        foil_ids = list(foil_ids)
+        for i in range(0, len(foil_ids), 500):
+            chunk = foil_ids[i:i + 500]
+            rows = session.query(cls.foil_id, balance, redeemed).filter(cls.foil_id.in_(chunk)).group_by(cls.foil_id)
+            for foil_id, foil_balance, redemption_txid in rows:
+                result[foil_id] = (foil_balance, redemption_txid)
+        return result
+
+    def __repr__(self):
+        return '<FoilTransfer %r %r>' % (self.txid, self.direction)
+
+class IndexedBlock(Base):
+    # the most recent blocks processed by the indexer, kept to detect rollbacks
+    __tablename__ = 'indexed_blocks'
+    height = Column(Integer, primary_key=True, autoincrement=False)
+    block_id = Column(String, nullable=False)
+
+    def __init__(self, height, block_id):
+        self.height = height
+        self.block_id = block_id
+
+    @classmethod
+    def last(cls, session):
+        return session.query(cls).order_by(desc(cls.height)).first()
+
+    @classmethod
+    def from_height(cls, session, height):
+        return session.query(cls).filter(cls.height >= height).order_by(cls.height).all()
+
+    @classmethod
+    def delete_from_height(cls, session, height):
+        session.query(cls).filter(cls.height >= height).delete(synchronize_session=False)
+
+    @classmethod
+    def prune_below(cls, session, height):
+        session.query(cls).filter(cls.height < height).delete(synchronize_session=False)
+
+class JournalEntry(Base):
+    # a signed transaction moving funds to or from a foil, tracked until it is broadcast
+    __tablename__ = 'journal'
+    id = Column(Integer, primary_key=True)
+    foil_id = Column(Integer, ForeignKey('foils.id'), nullable=False, index=True)
+    kind = Column(String, nullable=False)
+    txid = Column(String, nullable=False, index=True)
+    amount = Column(Integer, nullable=False)
+    # the signed data is kept in signed_transactions, only entries journaled by older versions carry their own
+    api = Column(String, nullable=True)
+    data = Column(Text, nullable=True)
+    status = Column(String, nullable=False, index=True)
+    date = Column(Integer, nullable=False)
+    error = Column(String, nullable=True)
+    expiry = Column(Integer, nullable=True)
+
+    KIND_SWEEP = "sweep"
+    KIND_FUND = "fund"
+
+    STATUS_SIGNED = "signed"
+    STATUS_BROADCAST = "broadcast"
+    STATUS_FAILED = "failed"
+    STATUS_EXPIRED = "expired"
+
+    def __init__(self, foil_id, kind, txid, amount, status, date, expiry=None):
+        self.foil_id = foil_id
+        self.kind = kind
+        self.txid = txid
+        self.amount = amount
+        self.status = status
+        self.date = date
+        self.expiry = expiry
+
+    @classmethod
+    def with_status(cls, session, kind, status):
+        return session.query(cls).filter(and_(cls.kind == kind, cls.status == status)).order_by(cls.id).all()
+
+    @classmethod
+    def mark_failed(cls, session, kind, txids, error):
+        txids = list(txids)
+        for i in range(0, len(txids), 500):
+            chunk = txids[i:i + 500]
+            session.query(cls).filter(and_(cls.kind == kind, cls.txid.in_(chunk))) \
+                .update({cls.status: cls.STATUS_FAILED, cls.error: error}, synchronize_session=False)
+
+    @classmethod
+    def latest(cls, session, kind, foil_ids):
+        # the most recent entry of kind for each of the foils
+        result = {}
+        foil_ids = list(foil_ids)
+        for i in range(0, len(foil_ids), 500):
+            chunk = foil_ids[i:i + 500]
+            entries = session.query(cls).filter(and_(cls.kind == kind, cls.foil_id.in_(chunk))).order_by(cls.id)
+            for entry in entries:
+                result[entry.foil_id] = entry
+        return result
+
+    def __repr__(self):
+        return '<JournalEntry %r %r>' % (self.txid, self.status)
+
+class SignedTransaction(Base):
+    # the signed data of a transaction, stored once however many foils it moves funds to or from
+    __tablename__ = 'signed_transactions'
+    txid = Column(String, primary_key=True)
+    api = Column(String, nullable=False)
+    data = Column(Text, nullable=False)
+
+    def __init__(self, txid, api, data):
+        self.txid = txid
+        self.api = api
+        self.data = data
+
+    @classmethod
+    def payloads(cls, session, entries):
+        # the api and signed data of the transaction of each journal entry by txid
+        result = dict((entry.txid, (entry.api, entry.data)) for entry in entries if entry.data)
+        txids = list(set(entry.txid for entry in entries) - set(result))
+        for i in range(0, len(txids), 500):
+            chunk = txids[i:i + 500]
+            for txid, api, data in session.query(cls.txid, cls.api, cls.data).filter(cls.txid.in_(chunk)):
+                result[txid] = (api, data)
+        return result
+
+    def __repr__(self):
+        return '<SignedTransaction %r>' % (self.txid)
@@ -0,0 +1,162 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+DEFAULT_CONCURRENCY = 10
+# requests per second, public nodes throttle clients that send more
+DEFAULT_RATE = 50
+DEFAULT_RETRIES = 3
+
+REQUEST_TIMEOUT = 30
+RETRY_STATUSES = (429, 502, 503, 504)
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+class RateLimiter:
+    # a token bucket, calls to wait() are allowed a burst of calls and then no more than rate per second, across threads
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # take a token now, going into debt when there are none so waiting callers queue up in order
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            METRICS.observe("rate_limit_wait_seconds", delay)
+            time.sleep(delay)
+
+def _endpoint(api):
+    # the api without its parameters, like /assets/balance, so metrics are not kept per address
+    return "/".join(api.split("?")[0].split("/")[:3])
+
+class NodeClient:
+    def __init__(self, node, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE, retries=DEFAULT_RETRIES):
+        self.node = node
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.limiter = RateLimiter(rate, self.concurrency)
+        # no more than concurrency requests in flight, however many threads share the client
+        self.in_flight = threading.BoundedSemaphore(self.concurrency)
+        self.cache = {}
+        # one keep-alive session shared by all worker threads, with a connection per worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _retry_delay(self, attempt, response):
+        # exponential backoff with full jitter, or as long as the node asks for
+        if response is not None and response.headers.get("retry-after", "").isdigit():
+            return int(response.headers["retry-after"])
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def request(self, method, api, **kwargs):
+        # send a request, retrying when throttled, on server errors and on connection errors
+        endpoint = _endpoint(api)
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            response = None
+            try:
+                with self.in_flight:
+                    with METRICS.timer("node_request_seconds", method=method, endpoint=endpoint):
+                        response = self.session.request(method, f"{self.node}{api}", timeout=REQUEST_TIMEOUT, **kwargs)
+                METRICS.count("node_responses", method=method, endpoint=endpoint, status=response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                METRICS.count("node_errors", method=method, endpoint=endpoint, error=type(e).__name__)
+                if attempt == self.retries:
+                    raise
+            if attempt == self.retries:
+                return response
+            METRICS.count("node_retries", method=method, endpoint=endpoint)
+            time.sleep(self._retry_delay(attempt, response))
+
+    def get(self, api):
+        response = self.request("GET", api)
+        response.raise_for_status()
+        return response.json()
+
+    def get_cached(self, api):
+        # for responses that never change, like the details of an asset
+        if api not in self.cache:
+            self.cache[api] = self.get(api)
+        return self.cache[api]
+
+    def post(self, api, payload):
+        response = self.request("POST", api, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    def transaction_statuses(self, txids):
+        # the status of many transactions in one request
+        return self.post("/transactions/status", {"ids": list(txids)})
+
+    def broadcast(self, api, data):
+        # post a signed transaction, returns the node's response which has an "error" key when it was rejected
+        response = self.request("POST", api, data=data, headers={"content-type": "application/json"})
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response.json()
+
+    def balance(self, address, assetid):
+        return self.get(f"/assets/balance/{address}/{assetid}")["balance"]
+
+    def waves_balance(self, address):
+        return self.get(f"/addresses/balance/{address}")["balance"]
+
+    def asset_details(self, assetid):
+        return self.get_cached(f"/assets/details/{assetid}")
+
+    def height(self):
+        return self.get("/blocks/height")["height"]
+
+    def distribution(self, assetid, height, limit=1000):
+        # stream (address, balance) for every holder of the asset at height, one page per request
+        after = None
+        while True:
+            api = f"/assets/{assetid}/distribution/{height}/limit/{limit}"
+            if after:
+                api += f"?after={after}"
+            page = self.get(api)
+            yield from page["items"].items()
+            if not page["hasNext"]:
+                break
+            after = page["lastItem"]
+
+    def address_transactions(self, address, limit=100):
+        # stream the transactions of an address, newest first, one page per request
+        after = None
+        while True:
+            api = f"/transactions/address/{address}/limit/{limit}"
+            if after:
+                api += f"?after={after}"
+            page = self.get(api)[0]
+            yield from page
+            if len(page) < limit:
+                break
+            after = page[-1]["id"]
+
+    def map(self, fn, items):
+        # run fn over items on a bounded worker pool, yielding results in the order of items
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            yield from executor.map(fn, items)
+
+    def balances(self, addresses, assetid):
+        return self.map(lambda address: self.balance(address, assetid), addresses)
@@ -0,0 +1,268 @@
+import io
+import multiprocessing
+import time
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+from image_cache import fingerprint
+from metrics import METRICS
+from workers import imap_window
+
+FONT_FILENAME = "Andale Mono.ttf"
+PDF_FONT_NAME = "AndaleMono"
+# bump when the drawing code changes, so cached pages are rendered again
+RENDER_VERSION = 1
+
+class Layout:
+    def __init__(self):
+        # consts
+        self.ppi = 72 # points per inch
+        self.dpi = 300
+        self.mm_per_in = 25.4
+
+        # page size
+        self.width_mm = 160
+        self.height_mm = 120
+        width_in = self.width_mm / self.mm_per_in
+        height_in = self.height_mm / self.mm_per_in
+        self.width = width_in * self.dpi
+        self.height = height_in * self.dpi
+        self.width_pts = width_in * self.ppi
+        self.height_pts = height_in * self.ppi
+
+        # qrcode width and y position
+        self.qrcode_x_center_mm = 20.4 + (39/2.0)
+        self.qrcode_y_center_mm = 22.1 + (39/2.0)
+        self.qrcode_x_center = self.qrcode_x_center_mm / self.mm_per_in * self.dpi
+        self.qrcode_y_center = self.qrcode_y_center_mm / self.mm_per_in * self.dpi
+        self.qrcode_width_mm = 39
+
+        # calc qrcode pix values
+        qrcode_width = self.qrcode_width_mm / self.mm_per_in * self.dpi
+        self.qrcode_border = 0
+        qrcode_boxes = 37 + self.qrcode_border + self.qrcode_border
+        self.qrcode_box_size = int(qrcode_width / qrcode_boxes)
+
+        # batch text
+        self.font_size = 30
+        self.font = ImageFont.truetype(FONT_FILENAME, self.font_size)
+        self.text_x_center_mm = 29.3 + (21.5/2.0)
+        self.text_y_center_mm = 120 - 9 - (8.9/2.0)
+        self.text_x_center = self.text_x_center_mm / self.mm_per_in * self.dpi
+        self.text_y_center = self.text_y_center_mm / self.mm_per_in * self.dpi
+
+    def mm_to_pts(self, mm):
+        return mm / self.mm_per_in * self.ppi
+
+    def px_to_pts(self, px):
+        return px / self.dpi * self.ppi
+
+    def fingerprint(self):
+        # a hash of everything that decides how a page looks
+        values = dict((k, v) for k, v in vars(self).items() if k != "font")
+        return fingerprint(RENDER_VERSION, FONT_FILENAME, values)
+
+def render_image(layout, batch, seed):
+    # create qr code image
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, \
+        box_size=layout.qrcode_box_size, border=layout.qrcode_border)
+    qr.add_data(seed)
+    qr.make()
+    qr_img = qr.make_image(fill_color="black", back_color="transparent")
+
+    # create template image
+    template = Image.new("RGBA", (int(layout.width), int(layout.height)))
+    # draw batch text
+    d = ImageDraw.Draw(template)
+    text = f"b{batch}"
+    text_width, text_height = layout.font.getsize(text)
+    text_x = layout.text_x_center - (text_width / 2)
+    text_y = layout.text_y_center - (text_height / 2)
+    d.text((int(text_x), int(text_y)), text, font=layout.font, fill="black")
+    # paste qr code
+    qrcode_x = layout.qrcode_x_center - (qr_img.size[0] / 2)
+    qrcode_y = layout.qrcode_y_center - (qr_img.size[1] / 2)
+    template.paste(qr_img, (int(qrcode_x), int(qrcode_y)))
+
+    return template
+
+def render_png(layout, batch, seed):
+    # encode in memory, the page only has to survive the trip back from the worker process
+    buf = io.BytesIO()
+    render_image(layout, batch, seed).save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+def register_pdf_font():
+    if PDF_FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, FONT_FILENAME))
+
+def draw_vector_page(pdf, layout, batch, seed):
+    # draw the qr code modules and batch text as pdf paths and text, at the same size and position
+    # as the raster page (pdf coordinates start at the bottom left)
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, \
+        box_size=layout.qrcode_box_size, border=layout.qrcode_border)
+    qr.add_data(seed)
+    qr.make()
+    matrix = qr.get_matrix()
+
+    # draw qr code, one rectangle per horizontal run of dark modules
+    module = layout.px_to_pts(layout.qrcode_box_size)
+    size = module * len(matrix)
+    left = layout.mm_to_pts(layout.qrcode_x_center_mm) - size / 2
+    top = layout.height_pts - layout.mm_to_pts(layout.qrcode_y_center_mm) + size / 2
+    path = pdf.beginPath()
+    for row, modules in enumerate(matrix):
+        y = top - (row + 1) * module
+        col = 0
+        while col < len(modules):
+            if not modules[col]:
+                col += 1
+                continue
+            start = col
+            while col < len(modules) and modules[col]:
+                col += 1
+            path.rect(left + start * module, y, (col - start) * module, module)
+    pdf.setFillColorRGB(0, 0, 0)
+    pdf.drawPath(path, stroke=0, fill=1)
+
+    # draw batch text, centered on the same point as the raster text
+    font_size = layout.px_to_pts(layout.font_size)
+    ascent = pdfmetrics.getAscent(PDF_FONT_NAME, font_size)
+    text_x = layout.mm_to_pts(layout.text_x_center_mm)
+    text_y = layout.height_pts - layout.mm_to_pts(layout.text_y_center_mm) - ascent / 2
+    pdf.setFont(PDF_FONT_NAME, font_size)
+    pdf.drawCentredString(text_x, text_y, f"b{batch}")
+
+# sheet sizes in mm, portrait
+SHEET_SIZES = {
+    "A4": (210, 297),
+    "A3": (297, 420),
+    "SRA3": (320, 450),
+}
+SHEET_TEMPLATE = "sheet"
+# crop marks start this far from the trimmed edge and are this long, the sheet keeps a margin for them
+CROP_MARK_OFFSET_MM = 2
+CROP_MARK_LENGTH_MM = 5
+
+class Imposition:
+    # a grid of foil pages centred on a print sheet, in pdf points from the bottom left of the sheet
+    def __init__(self, layout, sheet, columns=None, rows=None, gutter_mm=0, crop_marks=True):
+        self.layout = layout
+        self.crop_marks = crop_marks
+        self.gutter = layout.mm_to_pts(gutter_mm)
+        margin = layout.mm_to_pts(CROP_MARK_OFFSET_MM + CROP_MARK_LENGTH_MM) if crop_marks else 0
+        width_mm, height_mm = SHEET_SIZES[sheet]
+
+        # use the orientation that fits the most foils, unless the grid is given
+        def fit(width, height):
+            cols = int((width - 2 * margin + self.gutter) // (layout.width_pts + self.gutter))
+            rows = int((height - 2 * margin + self.gutter) // (layout.height_pts + self.gutter))
+            return cols, rows
+        portrait = (layout.mm_to_pts(width_mm), layout.mm_to_pts(height_mm))
+        landscape = (portrait[1], portrait[0])
+        options = []
+        for width, height in (portrait, landscape):
+            fit_cols, fit_rows = fit(width, height)
+            if (columns or fit_cols) <= fit_cols and (rows or fit_rows) <= fit_rows:
+                options.append(((columns or fit_cols) * (rows or fit_rows), (width, height), columns or fit_cols, rows or fit_rows))
+        if not options or not options[0][0]:
+            raise ValueError(f"a {columns or '?'}x{rows or '?'} grid of foils does not fit on {sheet}")
+        _, self.size, self.columns, self.rows = max(options, key=lambda option: option[0])
+
+        # tile origins, filled left to right and top to bottom
+        grid_width = self.columns * layout.width_pts + (self.columns - 1) * self.gutter
+        grid_height = self.rows * layout.height_pts + (self.rows - 1) * self.gutter
+        self.left = (self.size[0] - grid_width) / 2
+        self.bottom = (self.size[1] - grid_height) / 2
+        self.tiles = []
+        for row in range(self.rows):
+            for col in range(self.columns):
+                x = self.left + col * (layout.width_pts + self.gutter)
+                y = self.bottom + grid_height - (row + 1) * layout.height_pts - row * self.gutter
+                self.tiles.append((x, y))
+
+    def define_template(self, pdf):
+        # everything that is the same on every sheet goes into one form xobject, stored once in the pdf
+        pdf.beginForm(SHEET_TEMPLATE, 0, 0, self.size[0], self.size[1])
+        if self.crop_marks:
+            self._draw_crop_marks(pdf)
+        pdf.endForm()
+
+    def _draw_crop_marks(self, pdf):
+        offset = self.layout.mm_to_pts(CROP_MARK_OFFSET_MM)
+        length = self.layout.mm_to_pts(CROP_MARK_LENGTH_MM)
+        xs = sorted(set([x for x, y in self.tiles] + [x + self.layout.width_pts for x, y in self.tiles]))
+        ys = sorted(set([y for x, y in self.tiles] + [y + self.layout.height_pts for x, y in self.tiles]))
+        bottom, top = ys[0], ys[-1]
+        left, right = xs[0], xs[-1]
+        pdf.setLineWidth(0.25)
+        pdf.setStrokeColorRGB(0, 0, 0)
+        for x in xs:
+            pdf.line(x, bottom - offset, x, bottom - offset - length)
+            pdf.line(x, top + offset, x, top + offset + length)
+        for y in ys:
+            pdf.line(left - offset, y, left - offset - length, y)
+            pdf.line(right + offset, y, right + offset + length, y)
+
+class SheetPlacer:
+    # hands out the position of each foil page, starting a new sheet when the current one is full
+    def __init__(self, pdf, imposition):
+        self.pdf = pdf
+        self.imposition = imposition
+        self.tile = 0
+        imposition.define_template(pdf)
+
+    def next(self):
+        if self.tile == 0:
+            self.pdf.doForm(SHEET_TEMPLATE)
+        x, y = self.imposition.tiles[self.tile]
+        self.tile += 1
+        if self.tile == len(self.imposition.tiles):
+            self.tile = 0
+        return x, y
+
+    def end(self):
+        if self.tile == 0:
+            self.pdf.showPage()
+
+    def finish(self):
+        if self.tile:
+            self.pdf.showPage()
+
+class PagePlacer:
+    # one foil per page
+    def __init__(self, pdf):
+        self.pdf = pdf
+
+    def next(self):
+        return 0, 0
+
+    def end(self):
+        self.pdf.showPage()
+
+    def finish(self):
+        pass
+
+_layout = None
+
+def _init_worker():
+    # load the font and compute the page geometry once per worker
+    global _layout
+    _layout = Layout()
+
+def _render_job(job):
+    batch, seed = job
+    start = time.perf_counter()
+    png = render_png(_layout, batch, seed)
+    return png, time.perf_counter() - start
+
+def render_pngs(items, processes=None, job=None, chunksize=8):
+    # render pages on a process pool, job(item) is (batch, seed), yielding (item, png data) in the order of items
+    with multiprocessing.Pool(processes, _init_worker) as pool:
+        for item, (png, seconds) in imap_window(pool, _render_job, items, job, chunksize):
+            # the workers time the rendering, the metrics live in this process
+            METRICS.observe("render_seconds", seconds)
+            yield item, png
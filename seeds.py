@@ -0,0 +1,51 @@
+import functools
+import hashlib
+import os
+
+# a 12 word bip39 mnemonic is 128 bits of entropy and a 4 bit checksum, 11 bits a word
+SEED_WORDS = 12
+ENTROPY_BYTES = 16
+WORD_BITS = 11
+CHECKSUM_BITS = 4
+
+@functools.lru_cache(maxsize=None)
+def _mnemonic():
+    import mnemonic
+    return mnemonic.Mnemonic("english")
+
+@functools.lru_cache(maxsize=None)
+def _word_indexes():
+    return dict((word, i) for i, word in enumerate(_mnemonic().wordlist))
+
+def seed_entropy(seed):
+    # the entropy of a 12 word bip39 mnemonic, or None for any other seed (like the 15 word seeds pywaves makes)
+    # or one that would not come back exactly as stored, a dict lookup is far faster than Mnemonic.to_entropy
+    words = seed.split(" ")
+    if len(words) != SEED_WORDS:
+        return None
+    indexes = _word_indexes()
+    value = 0
+    for word in words:
+        i = indexes.get(word)
+        if i is None:
+            return None
+        value = value << WORD_BITS | i
+    entropy = (value >> CHECKSUM_BITS).to_bytes(ENTROPY_BYTES, "big")
+    if hashlib.sha256(entropy).digest()[0] >> (8 - CHECKSUM_BITS) != value & ((1 << CHECKSUM_BITS) - 1):
+        return None
+    return entropy
+
+def entropy_seed(entropy):
+    # the mnemonic of stored entropy
+    return _mnemonic().to_mnemonic(bytes(entropy))
+
+def as_seed(seed):
+    # a stored seed, either the mnemonic or the entropy of a compacted one
+    return entropy_seed(seed) if isinstance(seed, (bytes, bytearray, memoryview)) else seed
+
+def foil_seed(seed, entropy):
+    # the mnemonic of a foil from its seed and seed_entropy columns, only one of them is set
+    return seed if seed is not None else entropy_seed(entropy)
+
+def new_entropy():
+    return os.urandom(ENTROPY_BYTES)
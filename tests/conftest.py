@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+
+@pytest.fixture
+def fixture_path():
+    return lambda filename: os.path.join(FIXTURES, filename)
+
+@pytest.fixture
+def session():
+    # a fresh in-memory database for each test
+    import database
+    database.init_db("sqlite://")
+    yield database.db_session
+    database.db_session.remove()
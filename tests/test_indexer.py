@@ -0,0 +1,59 @@
+from indexer import Indexer, FixtureBlockSource
+from models import Foil, FoilTransfer, IndexedBlock
+
+ASSETID = "CgUrFtinLXEbJwJVjwwcppk4Vpz1nMmR3H5cQaDcUcfe"
+
+# the foils the recorded blocks fund: a and b in one mass transfer at height 2, c with a transfer at height 3,
+# in blocks.json a redeems at height 4, in blocks_fork.json the chain forks at height 4 and b redeems at 5
+FOIL_A = "3NsyuMNmPfYetW5v6JXmj54omLidkuVKnRy"
+FOIL_B = "3NjP2WPBg8Y4ErK9pGSSxY6BVScJy9uUxcJ"
+FOIL_C = "3NnTPkyRFA6CAFjF1YveCHK1ATbQgdM9mwZ"
+REDEMPTION_A = "86BNDCiapW3LjoRvQNVB716J6PTy8cqERPruLutU64nX"
+REDEMPTION_B = "VfaoYGBz134b2SCGB4r71gcjDATDafiZiiTugCZL5Lh4"
+
+def _foils(session):
+    rows = [{"date": 0, "batch": 1000, "seed": f"seed {i}", "address": address} \
+        for i, address in enumerate((FOIL_A, FOIL_B, FOIL_C))]
+    Foil.insert_many(session, rows)
+    session.commit()
+    return Foil.ids_from_addresses(session, (FOIL_A, FOIL_B, FOIL_C))
+
+def _balances(session, ids):
+    balances = FoilTransfer.balances(session, ids.values())
+    return dict((address, balances.get(foil_id, (0, None))) for address, foil_id in ids.items())
+
+def test_index_records_funding_and_redemptions(session, fixture_path):
+    ids = _foils(session)
+    indexer = Indexer(session, FixtureBlockSource(fixture_path("blocks.json")), ASSETID)
+
+    # the transfer of another asset at height 1 is ignored, the mass transfer funds two foils
+    assert indexer.run() == 4
+    assert _balances(session, ids) == {
+        FOIL_A: (501 - 500 - 1, REDEMPTION_A),
+        FOIL_B: (501, None),
+        FOIL_C: (1001, None),
+    }
+    assert IndexedBlock.last(session).height == 6
+
+def test_index_rerun_adds_nothing(session, fixture_path):
+    _foils(session)
+    indexer = Indexer(session, FixtureBlockSource(fixture_path("blocks.json")), ASSETID)
+    indexer.run()
+
+    assert indexer.run() == 0
+    assert session.query(FoilTransfer).count() == 4
+
+def test_index_rolls_back_a_fork(session, fixture_path):
+    ids = _foils(session)
+    Indexer(session, FixtureBlockSource(fixture_path("blocks.json")), ASSETID).run()
+
+    # the chain now has other blocks from height 4, the redemption of a is gone and b redeems instead
+    indexer = Indexer(session, FixtureBlockSource(fixture_path("blocks_fork.json")), ASSETID)
+    assert indexer.run() == 1
+    assert _balances(session, ids) == {
+        FOIL_A: (501, None),
+        FOIL_B: (501 - 500 - 1, REDEMPTION_B),
+        FOIL_C: (1001, None),
+    }
+    assert session.query(FoilTransfer).filter(FoilTransfer.txid == REDEMPTION_A).count() == 0
+    assert IndexedBlock.last(session).height == 7
@@ -0,0 +1,131 @@
+import functools
+import hashlib
+import json
+import math
+import multiprocessing
+import struct
+import time
+
+import base58
+import pywaves as pw
+import pywaves.crypto as crypto
+
+from addresses import init_offline_worker
+from metrics import METRICS
+from workers import imap_window
+
+TRANSFER_API = "/assets/broadcast/transfer"
+BROADCAST_API = "/transactions/broadcast"
+
+# the node rejects transactions with a timestamp more than two hours old, leave a margin before rebroadcasting
+MAX_SIGNED_AGE = 90 * 60
+
+# the maximum number of recipients in a mass transfer transaction
+MASS_TRANSFER_MAX = 100
+
+def mass_transfer_fee(count):
+    # 0.001 waves plus 0.0005 waves per recipient, rounded up to 0.001 waves
+    return 100000 + math.ceil(count / 2) * 100000
+
+def _b58encode(data):
+    encoded = base58.b58encode(data)
+    return encoded.decode() if isinstance(encoded, bytes) else encoded
+
+def _sign(sender, sdata):
+    signature = crypto.sign(sender.privateKey, sdata)
+    return signature.decode() if isinstance(signature, bytes) else signature
+
+def txid(sdata):
+    # the id of a transaction is the blake2b256 hash of its body bytes
+    return _b58encode(hashlib.blake2b(sdata, digest_size=32).digest())
+
+def transfer_bytes(public_key, recipient, assetid, amount, fee, fee_assetid, timestamp):
+    # the body bytes of a (version 1) transfer transaction, the same bytes pywaves' sendAsset signs
+    return b'\4' + \
+        base58.b58decode(public_key) + \
+        (b'\1' + base58.b58decode(assetid) if assetid else b'\0') + \
+        (b'\1' + base58.b58decode(fee_assetid) if fee_assetid else b'\0') + \
+        struct.pack(">Q", timestamp) + \
+        struct.pack(">Q", amount) + \
+        struct.pack(">Q", fee) + \
+        base58.b58decode(recipient) + \
+        struct.pack(">H", 0)
+
+def transfer(sender, recipient, assetid, amount, fee, fee_assetid, timestamp=0):
+    # sign a transfer transaction and return (txid, api, data)
+    if not timestamp:
+        timestamp = int(time.time() * 1000)
+    sdata = transfer_bytes(sender.publicKey, recipient, assetid, amount, fee, fee_assetid, timestamp)
+    data = json.dumps({
+        "assetId": assetid,
+        "feeAssetId": fee_assetid,
+        "senderPublicKey": sender.publicKey,
+        "recipient": recipient,
+        "amount": amount,
+        "fee": fee,
+        "timestamp": timestamp,
+        "attachment": "",
+        "signature": _sign(sender, sdata)
+    })
+    return txid(sdata), TRANSFER_API, data
+
+def mass_transfer_bytes(public_key, transfers, assetid, fee, timestamp):
+    # the body bytes of a (version 1) mass transfer transaction
+    transfers_data = b''
+    for t in transfers:
+        transfers_data += base58.b58decode(t["recipient"]) + struct.pack(">Q", t["amount"])
+    return b'\x0b' + \
+        b'\1' + \
+        base58.b58decode(public_key) + \
+        b'\1' + \
+        base58.b58decode(assetid) + \
+        struct.pack(">H", len(transfers)) + \
+        transfers_data + \
+        struct.pack(">Q", timestamp) + \
+        struct.pack(">Q", fee) + \
+        struct.pack(">H", 0)
+
+def mass_transfer(sender, transfers, assetid, fee, timestamp=0):
+    # sign a mass transfer transaction of [{"recipient", "amount"}] and return (txid, api, data)
+    if not timestamp:
+        timestamp = int(time.time() * 1000)
+    sdata = mass_transfer_bytes(sender.publicKey, transfers, assetid, fee, timestamp)
+    signature = _sign(sender, sdata)
+    data = json.dumps({
+        "type": 11,
+        "version": 1,
+        "assetId": assetid,
+        "senderPublicKey": sender.publicKey,
+        "fee": fee,
+        "timestamp": timestamp,
+        "transfers": transfers,
+        "attachment": "",
+        "signature": signature,
+        "proofs": [
+            signature
+        ]
+    })
+    return txid(sdata), BROADCAST_API, data
+
+def signed_age(data):
+    # seconds since a signed transaction's timestamp
+    return time.time() - json.loads(data)["timestamp"] / 1000
+
+@functools.lru_cache(maxsize=1)
+def _sender(seed):
+    # funding signs every job with the same seed, only derive its keys once per worker
+    return pw.Address(seed=seed)
+
+def _sign_transfer(job):
+    seed, recipient, assetid, amount, fee, fee_assetid = job
+    start = time.perf_counter()
+    signed = transfer(_sender(seed), recipient, assetid, amount, fee, fee_assetid)
+    return signed, time.perf_counter() - start
+
+def sign_transfers(items, processes=None, job=None, chunksize=16):
+    # sign transfers on a process pool, job(item) is (seed, recipient, assetid, amount, fee, fee_assetid),
+    # yielding (item, (txid, api, data)) in the order of items
+    with multiprocessing.Pool(processes, init_offline_worker, (pw.CHAIN, pw.CHAIN_ID)) as pool:
+        for item, (signed, seconds) in imap_window(pool, _sign_transfer, items, job, chunksize):
+            METRICS.observe("sign_seconds", seconds)
+            yield item, signed
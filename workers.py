@@ -0,0 +1,15 @@
+import itertools
+
+# the number of jobs read ahead of the worker processes, enough to keep them busy without holding a table in memory
+DEFAULT_WINDOW = 2000
+
+def imap_window(pool, fn, items, job=None, chunksize=1, window=DEFAULT_WINDOW):
+    # like pool.imap, yielding (item, fn(job(item))) in the order of items, but items are read in the calling thread
+    # a window at a time, so they can stream straight from the database
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, window))
+        if not chunk:
+            break
+        jobs = [job(item) for item in chunk] if job else chunk
+        yield from zip(chunk, pool.imap(fn, jobs, chunksize))
@@ -1,25 +1,35 @@
 #!/usr/bin/env python3.7
 
+import time
+# the start of startup, for --timing
+_start = time.perf_counter()
+
 import sys
 import os
 import argparse
-import time
 import re
 import getpass
 import datetime
 import json
+import io
+import hashlib
+import itertools
+import shutil
 
 import requests
-import mnemonic
 import pywaves as pw
-import qrcode
-import PIL
-from PIL import ImageFont
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch, cm
 
-from database import db_session, init_db
-from models import Foil
+from database import db_session, init_db, DEFAULT_POOL_SIZE, DEFAULT_DB_TIMEOUT
+from models import Foil, FoilTransfer, JournalEntry, SignedTransaction, STREAM_CHUNK_SIZE, FOIL_FIELD_NAMES, foil_serializer, foil_json_line
+from node import NodeClient, RateLimiter, DEFAULT_CONCURRENCY, DEFAULT_RATE, DEFAULT_RETRIES
+from addresses import offline_address, stored_address, foil_address, derive_addresses, generate_addresses
+from transactions import sign_transfers, transfer, mass_transfer, mass_transfer_fee, signed_age, MAX_SIGNED_AGE, \
+    MASS_TRANSFER_MAX
+from create_batch_spec import plan_funding, read_spec
+from indexer import Indexer, NodeBlockSource, FixtureBlockSource, DEFAULT_ROLLBACK_DEPTH
+from metrics import METRICS
+from export import export_rows, format_from_path, FORMATS as EXPORT_FORMATS
+from seeds import seed_entropy, foil_seed
 
 TESTNET_NODE = "https://testnet1.wavesnodes.com"
 MAINNET_NODE = "https://nodes.wavesnodes.com"
@@ -36,80 +46,215 @@ EXIT_TOO_MANY_TXS = 14
 EXIT_NOT_TRANSFER_ASSET = 15
 EXIT_UNRECOGNISED_ASSET_ID = 16
 EXIT_WRONG_RECIPIENT = 17
+EXIT_CHECK_FAILED = 18
+EXIT_FUNDING_FAILED = 19
+EXIT_FILL_FAILED = 20
+EXIT_EXPORT_FAILED = 21
+EXIT_IMAGES_FAILED = 22
+EXIT_DB_FAILED = 23
+EXIT_INVALID_FIELDS = 24
+
+# the default limit of transactions broadcast per second
+DEFAULT_BROADCAST_RATE = 20
+
+# the number of functions listed after a --profile run
+PROFILE_SUMMARY_LINES = 25
+
+def get_asset_fee(client, assetid):
+    return client.asset_details(assetid)["minSponsoredAssetFee"]
 
-def get_asset_fee(assetid):
-    url = f"{pw.NODE}/assets/details/{assetid}"
-    response = requests.get(url).json()
-    min_asset_fee = response["minSponsoredAssetFee"]
-    return min_asset_fee
+_client = None
+
+def _chunks(items, size):
+    # group a stream of items into lists of up to size items
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _node_client(args, retries=None):
+    # every command shares one client, so connections, the rate limit and the cache are shared too
+    global _client
+    if not _client:
+        _client = NodeClient(pw.NODE, args.concurrency, args.node_rate, args.node_retries)
+    if retries is not None:
+        _client.retries = retries
+    return _client
+
+def _flag(value):
+    # a true or false argument, bool() is true for any non empty string, even "0" or "false"
+    if value.lower() in ("true", "yes", "1"):
+        return True
+    if value.lower() in ("false", "no", "0"):
+        return False
+    raise argparse.ArgumentTypeError(f"'{value}' is not true or false")
 
 def construct_parser():
     # construct argument parser
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-m", "--mainnet", action="store_true", help="Set to use mainnet (default: false)")
+    parser.add_argument("--timing", action="store_true", help="Report how long startup and the command took, on stderr")
+    parser.add_argument("--metrics", metavar="FILE", help="Write timers, counts and latency histograms of node requests, db commits, signing and rendering to FILE at exit (prometheus text if it ends in .prom, json otherwise)")
+    parser.add_argument("--profile", metavar="FILE", help="Run the command under cProfile and dump the stats to FILE")
+    parser.add_argument("-n", "--node", help="The url of the node to use instead of the default node of the network")
+    parser.add_argument("-j", "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help=f"The maximum number of concurrent node requests (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--node-rate", type=float, default=DEFAULT_RATE, help=f"The maximum number of node requests per second, 0 for no limit (default: {DEFAULT_RATE})")
+    parser.add_argument("--node-retries", type=int, default=DEFAULT_RETRIES, help=f"The number of times to retry a throttled or failed node request (default: {DEFAULT_RETRIES})")
+    parser.add_argument("--db", metavar="URL", help="The database url, like sqlite:///foils.db or postgresql://user@host/zap_foils (default: $ZAP_FOIL_DB or zap_foils.db next to this script)")
+    parser.add_argument("--db-pool-size", type=int, default=DEFAULT_POOL_SIZE, help=f"The number of connections kept open to a database server (default: {DEFAULT_POOL_SIZE})")
+    parser.add_argument("--db-timeout", type=float, default=DEFAULT_DB_TIMEOUT, help=f"Seconds to wait for a database lock or connection (default: {DEFAULT_DB_TIMEOUT})")
     
     subparsers = parser.add_subparsers(dest="command")
 
     parser_create = subparsers.add_parser("create", help="Create foils")
     parser_create.add_argument("batchsize", metavar="BATCHSIZE", type=int, help="The number of foils to create in this batch")
     parser_create.add_argument("batchcount", metavar="BATCHCOUNT", type=int, help="The number of batches to create")
+    parser_create.add_argument("-p", "--processes", type=int, default=None, help="The number of worker processes generating seeds (default: cpu count)")
+    parser_create.add_argument("-c", "--compact", action="store_true", help="Create 12 word bip39 seeds stored as their 16 bytes of entropy (default: false)")
 
     parser_fund = subparsers.add_parser("fund", help="Fund foils")
     parser_fund.add_argument("batch", metavar="BATCH", type=int, help="The batch to fund")
     parser_fund.add_argument("amount", metavar="AMOUNT", type=int, help="The amount of in each foil in this batch (in zap cents!)")
     parser_fund.add_argument("-e", "--expiry", type=str, help="The expiry time to use (if you want to override the default - ie two months), number of seconds or '<X>days'")
+    parser_fund.add_argument("-M", "--mass-transfer", action="store_true", help=f"Fund up to {MASS_TRANSFER_MAX} foils per mass transfer, fees are paid in waves (default: false)")
+    parser_fund.add_argument("-o", "--sign-only", action="store_true", help="Sign the transfers offline into the journal, only the asset fee is looked up on the node, send them later with 'broadcast' (default: false)")
+    parser_fund.add_argument("-p", "--processes", type=int, default=None, help="The number of signing processes for --sign-only (default: cpu count)")
 
     parser_fund_multiple = subparsers.add_parser("fund_multiple", help="Fund foils from a batch spec file")
-    parser_fund_multiple.add_argument("filename", metavar="FILENAME", type=str, help="The batch spec file")
+    parser_fund_multiple.add_argument("filename", metavar="FILENAME", type=str, help="The batch spec or plan file written by create_batch_spec.py")
     parser_fund_multiple.add_argument("-e", "--expiry", type=str, help="The expiry time to use (if you want to override the default - ie two months), number of seconds or '<X>days'")
+    parser_fund_multiple.add_argument("-M", "--mass-transfer", action="store_true", help=f"Fund up to {MASS_TRANSFER_MAX} foils per mass transfer, fees are paid in waves (default: false)")
+    parser_fund_multiple.add_argument("-o", "--sign-only", action="store_true", help="Sign the transfers offline into the journal, only the asset fee is looked up on the node, send them later with 'broadcast' (default: false)")
+    parser_fund_multiple.add_argument("-p", "--processes", type=int, default=None, help="The number of signing processes for --sign-only (default: cpu count)")
 
     parser_check_multiple = subparsers.add_parser("check_multiple", help="Check foils from a batch spec file")
-    parser_check_multiple.add_argument("filename", metavar="FILENAME", type=str, help="The batch spec file")
+    parser_check_multiple.add_argument("filename", metavar="FILENAME", type=str, help="The batch spec or plan file written by create_batch_spec.py")
+    parser_check_multiple.add_argument("-i", "--indexed", action="store_true", help="Use the balances recorded by the indexer instead of querying the node (default: false)")
+
+    parser_confirm = subparsers.add_parser("confirm", help="Check that recorded funding transactions were confirmed")
+    parser_confirm.add_argument("-c", "--chunk-size", type=int, default=500, help="The number of transaction ids per status request (default: 500)")
+    parser_confirm.add_argument("-g", "--grace", type=int, default=600, help="Seconds after funding before a missing transaction counts as not found, it is dropped when still not found on the next run (default: 600)")
+    parser_confirm.add_argument("-f", "--follow", type=int, default=None, help="Keep checking, polling every FOLLOW seconds")
+
+    parser_reconcile = subparsers.add_parser("reconcile", help="Reconcile foil balances against the asset distribution")
+    parser_reconcile.add_argument("batch_start", metavar="BATCH_START", type=int, help="The batch number to start at")
+    parser_reconcile.add_argument("batch_end", metavar="BATCH_END", type=int, help="The batch number to end at")
+    parser_reconcile.add_argument("-s", "--spec", type=str, default=None, help="The batch spec or plan file with the expected amounts (default: the amount of each foil)")
+    parser_reconcile.add_argument("-v", "--verbose", action="store_true", help="Also list empty (redeemed or unfunded) foils")
 
     parser_fill_missing_fund_data = subparsers.add_parser("fill_missing_fund_data", help="If we dont have a record of the funding tx, fill it in now")
     parser_fill_missing_fund_data.add_argument("batch_start", metavar="BATCH_START", type=int, help="The batch number to start at")
     parser_fill_missing_fund_data.add_argument("batch_end", metavar="BATCH_END", type=int, help="The batch number to end at")
 
+    parser_addresses = subparsers.add_parser("addresses", help="Store the derived address of foils that do not have one yet")
+    parser_addresses.add_argument("-f", "--force", action="store_true", help="Rederive the address of every foil (default: false)")
+    parser_addresses.add_argument("-p", "--processes", type=int, default=None, help="The number of worker processes (default: cpu count)")
+
+    parser_compact = subparsers.add_parser("compact", help="Store the seeds of foils that are 12 word bip39 mnemonics as their entropy")
+    parser_compact.add_argument("--vacuum", action="store_true", help="Rebuild the sqlite database file afterwards to give the freed space back (default: false)")
+
     parser_show = subparsers.add_parser("show", help="Show foils")
-    parser_show.add_argument("-b", "--batch", type=int, default=None, help="The batch to show")
+    parser_show.add_argument("-b", "--batch", type=int, default=None, help="The batch to show, or the first batch with --batch-end")
+    parser_show.add_argument("-e", "--batch-end", type=int, default=None, help="The last batch to show")
+    parser_show.add_argument("-a", "--amount", type=int, default=None, help="Only foils of this amount (in zap cents)")
+    parser_show.add_argument("-f", "--fields", default=None, help=f"The comma separated fields to show, only they are read from the database (default: {','.join(FOIL_FIELD_NAMES)})")
+    parser_show.add_argument("-l", "--jsonl", action="store_true", help="Write one json object per line, for jq and other tools (default: false)")
+    parser_show_funding = parser_show.add_mutually_exclusive_group()
+    parser_show_funding.add_argument("--funded", action="store_true", help="Only foils that have been funded")
+    parser_show_funding.add_argument("--unfunded", action="store_true", help="Only foils that have not been funded")
+    parser_show_expiry = parser_show.add_mutually_exclusive_group()
+    parser_show_expiry.add_argument("--expired", action="store_true", help="Only foils that have expired")
+    parser_show_expiry.add_argument("--unexpired", action="store_true", help="Only foils that have not expired")
     parser_show.add_argument("-c", "--check", action="store_true", help="Query the balance for each foil")
+    parser_show.add_argument("-i", "--indexed", action="store_true", help="Show the balance and redemption recorded by the indexer for each foil")
 
     parser_images = subparsers.add_parser("images", help="Create qrcode images")
+    parser_images.add_argument("-v", "--vector", action="store_true", help="Draw the qrcodes and text as vectors instead of embedding page images (default: false)")
+    parser_images.add_argument("--png", action="store_true", help="Also write a png file for each foil (default: false)")
+    parser_images.add_argument("-p", "--processes", type=int, default=None, help="The number of render processes (default: cpu count)")
+    parser_images.add_argument("-s", "--sheet", choices=["A4", "A3", "SRA3"], default=None, help="Impose several foils on each sheet of this size instead of one foil per page")
+    parser_images.add_argument("-g", "--grid", default=None, help="The columns and rows of foils on a sheet, like 2x2 (default: as many as fit)")
+    parser_images.add_argument("--gutter", type=float, default=5, help="The space between foils on a sheet in mm (default: 5)")
+    parser_images.add_argument("--no-crop-marks", action="store_true", help="Leave the crop marks off the sheets (default: false)")
+    parser_images.add_argument("-b", "--batch", type=int, default=None, help="The batch to start with (default: the first batch)")
+    parser_images.add_argument("-e", "--batch-end", type=int, default=None, help="The batch to end with (default: the last batch)")
+    parser_images.add_argument("-B", "--per-batch", action="store_true", help="Write a pdf for each batch, only for batches that changed, instead of images.pdf (default: false)")
+    parser_images.add_argument("-f", "--force", action="store_true", help="Render every page again instead of using the cached pages (default: false)")
 
     parser_csv = subparsers.add_parser("csv", help="Create csv")
     parser_csv.add_argument("-b", "--batch", type=int, default=0, help="The batch to start with (default: 0)")
     parser_csv.add_argument("-s", "--seeds", action="store_true", help="Only the seeds (default: false)")
+    parser_csv.add_argument("-e", "--batch-end", type=int, default=None, help="The batch to end with (default: the last batch)")
+    parser_csv.add_argument("-o", "--output", default="codes.csv", help="The file to write, '-' for stdout (default: codes.csv)")
+    parser_csv.add_argument("-f", "--format", choices=EXPORT_FORMATS, default=None, help="The export format (default: from the output file extension, or csv)")
+    parser_csv.add_argument("-z", "--gzip", action="store_true", help="Compress the output with gzip (default: when the output ends with .gz)")
+    parser_csv_funding = parser_csv.add_mutually_exclusive_group()
+    parser_csv_funding.add_argument("--funded", action="store_true", help="Only foils that have been funded")
+    parser_csv_funding.add_argument("--unfunded", action="store_true", help="Only foils that have not been funded")
 
     parser_sweep = subparsers.add_parser("sweep", help="Sweep expired foils")
     parser_sweep.add_argument("recipient", metavar="RECIPIENT", type=str, help="The recipient of the swept funds")
     parser_sweep.add_argument("batch_start", metavar="BATCH_START", type=int, help="The start batch number")
     parser_sweep.add_argument("batch_end", metavar="BATCH_END", type=int, help="The end batch number")
-    parser_sweep.add_argument("ignore_expiry", metavar="IGNORE_EXPIRY", type=bool, help="Whether to ignore expiry")
+    parser_sweep.add_argument("ignore_expiry", metavar="IGNORE_EXPIRY", type=_flag, help="Whether to ignore expiry (true/false, yes/no or 1/0)")
+    parser_sweep.add_argument("-p", "--processes", type=int, default=None, help="The number of signing processes (default: cpu count)")
+    parser_sweep.add_argument("-r", "--rate", type=float, default=DEFAULT_BROADCAST_RATE, help=f"The maximum number of broadcasts per second (default: {DEFAULT_BROADCAST_RATE})")
+    parser_sweep.add_argument("-i", "--indexed", action="store_true", help="Use the balances recorded by the indexer instead of querying the node (default: false)")
+
+    parser_sweep_due = subparsers.add_parser("sweep_due", help="Sweep the funded foils that have expired since they were last swept")
+    parser_sweep_due.add_argument("recipient", metavar="RECIPIENT", type=str, help="The recipient of the swept funds")
+    parser_sweep_due.add_argument("-l", "--limit", type=int, default=STREAM_CHUNK_SIZE, help=f"The number of foils to sweep at a time (default: {STREAM_CHUNK_SIZE})")
+    parser_sweep_due.add_argument("-w", "--interval", type=float, default=0, help="Keep running, looking for newly expired foils every this many seconds (default: 0, run once)")
+    parser_sweep_due.add_argument("-p", "--processes", type=int, default=None, help="The number of signing processes (default: cpu count)")
+    parser_sweep_due.add_argument("-r", "--rate", type=float, default=DEFAULT_BROADCAST_RATE, help=f"The maximum number of broadcasts per second (default: {DEFAULT_BROADCAST_RATE})")
+    parser_sweep_due.add_argument("-i", "--indexed", action="store_true", help="Use the balances recorded by the indexer instead of querying the node (default: false)")
+
+    parser_broadcast = subparsers.add_parser("broadcast", help="Broadcast signed transactions from the journal")
+    parser_broadcast.add_argument("-k", "--kind", type=str, default=JournalEntry.KIND_FUND, choices=(JournalEntry.KIND_FUND, JournalEntry.KIND_SWEEP), help=f"The kind of transactions to broadcast (default: {JournalEntry.KIND_FUND})")
+    parser_broadcast.add_argument("-r", "--rate", type=float, default=DEFAULT_BROADCAST_RATE, help=f"The maximum number of broadcasts per second (default: {DEFAULT_BROADCAST_RATE})")
+    parser_broadcast.add_argument("--retries", type=int, default=3, help="The number of times to retry a broadcast that could not reach the node (default: 3)")
+    parser_broadcast.add_argument("--retry-failed", action="store_true", help="Also rebroadcast transactions the node rejected before (default: false)")
+
+    parser_index = subparsers.add_parser("index", help="Record transfers to and from foil addresses by scanning blocks")
+    parser_index.add_argument("-s", "--start", type=int, default=1, help="The height to start at when nothing has been indexed yet (default: 1)")
+    parser_index.add_argument("-r", "--rollback-depth", type=int, default=DEFAULT_ROLLBACK_DEPTH, help=f"The number of recent blocks to recheck for rollbacks (default: {DEFAULT_ROLLBACK_DEPTH})")
+    parser_index.add_argument("-f", "--follow", type=int, default=None, help="Keep indexing new blocks, polling every FOLLOW seconds")
+    parser_index.add_argument("--fixture", type=str, default=None, help="Read blocks from a json file recorded from /blocks/seq instead of the node")
 
     return parser
 
 def create_run(args):
-    pw.setOffline()
     # get free batch id
     batch = Foil.next_batch_id(db_session)
 
+    # generate seeds and addresses in parallel, and insert them in chunks
+    chunk_size = 5000
+    rows = []
+    pairs = generate_addresses(args.batchsize * args.batchcount, args.processes, compact=args.compact)
+    seed_column = "seed_entropy" if args.compact else "seed"
     for i in range(args.batchcount):
         # create foil
         for i in range(args.batchsize):
-            # create entry in db
-            date = time.time()
-            addr = pw.Address()
-            foil = Foil(date, batch, addr.seed, None, None, None, None)
-            db_session.add(foil)
+            seed, address = next(pairs)
+            rows.append({"date": time.time(), "batch": batch, seed_column: seed, "address": address})
+            if len(rows) >= chunk_size:
+                Foil.insert_many(db_session, rows)
+                rows = []
         print(f"batch {batch}")
         # increment batch number
         batch += 1
 
+    Foil.insert_many(db_session, rows)
     db_session.commit()
 
 def _check_mnemonic(seed):
     # check seed is valid bip39 mnemonic
+    import mnemonic
     m = mnemonic.Mnemonic("english")
     if m.check(seed.strip()):
         seed = seed.strip()
@@ -120,11 +265,11 @@ def _check_mnemonic(seed):
         if a not in ("y", "Y"):
             sys.exit(EXIT_SEED_INVALID)
 
-def _create_pwaddr(seed, required_funds):
+def _create_pwaddr(client, seed, required_funds):
     # create pywaves sender address
-    sender = pw.Address(seed=seed)
+    sender = offline_address(seed)
     print(f"Account: {sender.address}")
-    balance = sender.balance(assetId=args.assetid)
+    balance = client.balance(sender.address, args.assetid)
     print(f"Balance: {balance} ({args.assetid})")
     if balance < required_funds:
         print(f"ERROR: balance of account ({balance}) not great enough ({required_funds} required)")
@@ -132,12 +277,7 @@ def _create_pwaddr(seed, required_funds):
 
     return sender
 
-def _fund(seed, batch, amount, provided_expiry, required_funds, assetid):
-    _check_mnemonic(seed)
-
-    sender = _create_pwaddr(seed, required_funds)
-
-    # set expiry
+def _expiry(provided_expiry):
     date = time.time()
     two_months = 60 * 60 * 24 * 30 * 2
     expiry = date + two_months
@@ -153,314 +293,1010 @@ def _fund(seed, batch, amount, provided_expiry, required_funds, assetid):
             except:
                 print("ERROR: expiry not a valid number")
                 sys.exit(EXIT_EXPIRY_INVALID)
+    return expiry
+
+def _print_expiry(batch, expiry):
     dt = datetime.datetime.fromtimestamp(expiry)
     nice_expiry = dt.strftime("%Y/%m/%d %H:%M:%S")
     print(f"Batch (#{batch}) expiry: {nice_expiry} ({expiry})")
-    
-    # add funds and expiry
-    asset = pw.Asset(assetid)
-    foils = Foil.get_batch(db_session, batch)
+
+def _unfunded_foils(client, foils, assetid):
+    # skip foils that have been funded already, balances are queried as one concurrent batch, foils whose
+    # funding was dropped are funded again
+    pending = []
     for foil in foils:
-        addr = pw.Address(seed=foil.seed)
-        if foil.funding_txid:
-            print(f"Skipping {addr.address}, funding_txid is not empty")
+        address = foil_address(foil)
+        if foil.funded:
+            print(f"Skipping {address}, funding_txid is not empty")
             continue
-        balance = addr.balance(assetId=assetid)
+        pending.append((foil, address))
+    addresses = [address for foil, address in pending]
+    unfunded = []
+    for (foil, address), balance in zip(pending, client.balances(addresses, assetid)):
         if balance > 0:
-            print(f"Skipping {addr.address}, balance ({balance}) is not 0")
+            print(f"Skipping {address}, balance ({balance}) is not 0")
             continue
-        result = sender.sendAsset(addr, asset, amount, feeAsset=asset, txFee=1)
-        foil.expiry = expiry
-        foil.funding_date = time.time()
-        foil.funding_txid = result["id"]
-        db_session.add(foil)
+        unfunded.append((foil, address))
+    return unfunded
+
+def _iter_unfunded(client, foils, assetid):
+    for chunk in _chunks(foils, STREAM_CHUNK_SIZE):
+        yield from _unfunded_foils(client, chunk, assetid)
+
+def _fund(client, sender, batch, amount, fee, expiry, assetid):
+    _print_expiry(batch, expiry)
+
+    # add funds and expiry
+    for foil, address in _iter_unfunded(client, Foil.iter_batch(db_session, batch), assetid):
+        txid, api, data = transfer(sender, address, assetid, amount, fee, assetid)
+        result = client.broadcast(api, data)
+        if "error" in result:
+            print(f"ERROR: transfer failed ({result})")
+            sys.exit(EXIT_FUNDING_FAILED)
+        db_session.bulk_update_mappings(Foil, [Foil.funding_update(foil.id, txid, time.time(), expiry, amount)])
+        db_session.commit()
+        print(f"Funded {address} with {amount}")
+
+def _fund_batches(client, seed, plan, provided_expiry, assetid):
+    _check_mnemonic(seed)
+
+    # the balance has to cover every batch of the plan
+    sender = _create_pwaddr(client, seed, plan.required_funds)
+
+    # set expiry
+    expiry = _expiry(provided_expiry)
+
+    for batch, amount, foils, unfunded in plan.batches:
+        if unfunded:
+            _fund(client, sender, batch, amount, plan.fee, expiry, assetid)
+
+def _fund_mass(client, seed, plan, provided_expiry, assetid):
+    _check_mnemonic(seed)
+
+    sender = _create_pwaddr(client, seed, plan.required_funds)
+
+    # set expiry
+    expiry = _expiry(provided_expiry)
+    for batch, amount in plan.spec():
+        _print_expiry(batch, expiry)
+
+    # mass transfer fees can only be paid in waves, check there is enough for every foil without a funding tx
+    balance = client.waves_balance(sender.address)
+    print(f"Waves balance: {balance} ({plan.required_fee} required for up to {len(plan.chunks)} mass transfers)")
+    if balance < plan.required_fee:
+        print(f"ERROR: waves balance of account ({balance}) not great enough ({plan.required_fee} required)")
+        sys.exit(EXIT_BALANCE_INSUFFICIENT)
+
+    # add funds and expiry, one mass transfer and one db transaction per chunk of the unfunded foils
+    batches = [batch for batch, amount, foils, unfunded in plan.batches if unfunded]
+    unfunded = _iter_unfunded(client, Foil.iter_batches(db_session, batches), assetid)
+    for chunk in _chunks(unfunded, MASS_TRANSFER_MAX):
+        transfers = [{"recipient": address, "amount": plan.amounts[foil.batch]} for foil, address in chunk]
+        txid, api, data = mass_transfer(sender, transfers, assetid, mass_transfer_fee(len(transfers)))
+        result = client.broadcast(api, data)
+        if "error" in result:
+            print(f"ERROR: mass transfer failed ({result})")
+            sys.exit(EXIT_FUNDING_FAILED)
+        funding_date = time.time()
+        db_session.bulk_update_mappings(Foil, [Foil.funding_update(foil.id, txid, funding_date, expiry, \
+            plan.amounts[foil.batch]) for foil, address in chunk])
         db_session.commit()
-        print(f"Funded {addr.address} with {amount}")
+        print(f"Funded {len(chunk)} foils in mass transfer {txid}")
 
-def _check(batch, amount, assetid):
-    print(f":: batch {batch} - amount {amount}")
-    asset = pw.Asset(assetid)
-    foils = Foil.get_batch(db_session, batch)
+def _unsigned_foils(foils):
+    # skip foils that are funded or have a funding transaction waiting to be broadcast, foils whose funding was
+    # rejected, dropped or can no longer be sent are signed again, a transaction the node may have taken before a
+    # request failed is only replaced once its signature has expired
+    journal = JournalEntry.latest(db_session, JournalEntry.KIND_FUND, [foil.id for foil in foils])
+    payloads = SignedTransaction.payloads(db_session, [entry for entry in journal.values() \
+        if entry.status == JournalEntry.STATUS_SIGNED])
+    pending = []
     for foil in foils:
-        addr = pw.Address(seed=foil.seed)
-        balance = addr.balance(assetId=assetid)
-        if balance > 0:
-            print(f"balance: {balance} addr: {addr.address}")
-            if balance != amount and balance != amount - 1:
-                print(f"ERROR - address ({addr.address}) has wrong balance")
-                sys.exit(2)
+        address = foil_address(foil)
+        if foil.funded:
+            print(f"Skipping {address}, funding_txid is not empty")
+            continue
+        entry = journal.get(foil.id)
+        if entry and (entry.status == JournalEntry.STATUS_BROADCAST or \
+                entry.status == JournalEntry.STATUS_SIGNED and signed_age(payloads[entry.txid][1]) < MAX_SIGNED_AGE):
+            print(f"Skipping {address}, already {entry.status} in {entry.txid}")
+            continue
+        pending.append((foil, address))
+    return pending
+
+def _sign_fund(seed, plan, provided_expiry, assetid, processes):
+    # sign the funding transfers offline into the journal, the broadcast command sends them
+    _check_mnemonic(seed)
+    pw.setOffline()
+    sender = pw.Address(seed=seed)
+    print(f"Account: {sender.address}")
+
+    # set expiry
+    expiry = _expiry(provided_expiry)
+    for batch, amount in plan.spec():
+        _print_expiry(batch, expiry)
+
+    # sign the foils that are not funded and have no funding transaction waiting to be broadcast
+    amounts = plan.amounts
+    foils = Foil.iter_batches(db_session, [batch for batch, amount, foils, unfunded in plan.batches if unfunded])
+    pending = (item for chunk in _chunks(foils, STREAM_CHUNK_SIZE) for item in _unsigned_foils(chunk))
+    date = time.time()
+    count = 0
+    if plan.mass:
+        for chunk in _chunks(pending, MASS_TRANSFER_MAX):
+            transfers = [{"recipient": address, "amount": amounts[foil.batch]} for foil, address in chunk]
+            txid, api, data = mass_transfer(sender, transfers, assetid, mass_transfer_fee(len(chunk)))
+            db_session.add(SignedTransaction(txid, api, data))
+            for foil, address in chunk:
+                db_session.add(JournalEntry(foil.id, JournalEntry.KIND_FUND, txid, amounts[foil.batch], \
+                    JournalEntry.STATUS_SIGNED, date, expiry))
+            count += len(chunk)
+    else:
+        # the foil's id and batch are read before the signed entries are committed
+        pending = ((foil.id, foil.batch, address) for foil, address in pending)
+        job = lambda item: (seed, item[2], assetid, amounts[item[1]], plan.fee, assetid)
+        for (foil_id, batch, address), (txid, api, data) in sign_transfers(pending, processes, job):
+            db_session.add(SignedTransaction(txid, api, data))
+            db_session.add(JournalEntry(foil_id, JournalEntry.KIND_FUND, txid, amounts[batch], \
+                JournalEntry.STATUS_SIGNED, date, expiry))
+            count += 1
+            if count % STREAM_CHUNK_SIZE == 0:
+                db_session.commit()
+    db_session.commit()
+    print(f"Signed funding for {count} foils, run 'broadcast' within {MAX_SIGNED_AGE // 60} minutes to send them")
+
+def _indexed_balances(foils):
+    # balances recorded by the indexer, in the order of foils
+    balances = FoilTransfer.balances(db_session, [foil.id for foil in foils])
+    return [balances.get(foil.id, (0, None))[0] for foil in foils]
+
+def _balance_ok(balance, amount):
+    # a foil may have paid the 1 cent fee of a transfer already
+    return balance == amount or balance == amount - 1
+
+def _check(client, foils, amounts, assetid, indexed=False):
+    # check the balance of each foil against the amount of its batch, a chunk of foils at a time across batches
+    errors = []
+    batch = None
+    for chunk in _chunks(foils, STREAM_CHUNK_SIZE):
+        addresses = [foil_address(foil) for foil in chunk]
+        if indexed:
+            balances = _indexed_balances(chunk)
         else:
-            print(f"ERROR - address ({addr.address}) has no balance")
-            sys.exit(1)
+            balances = client.balances(addresses, assetid)
+        for foil, address, balance in zip(chunk, addresses, balances):
+            if foil.batch != batch:
+                batch = foil.batch
+                print(f":: batch {batch} - amount {amounts[batch]}")
+            if balance > 0:
+                print(f"balance: {balance} addr: {address}")
+                if not _balance_ok(balance, amounts[batch]):
+                    print(f"ERROR - address ({address}) has wrong balance")
+                    errors.append((batch, address, balance, "wrong balance"))
+            else:
+                print(f"ERROR - address ({address}) has no balance")
+                errors.append((batch, address, balance, "no balance"))
+    return errors
+
+def _fund_plan(args, client, seed, plan):
+    if args.sign_only:
+        _sign_fund(seed, plan, args.expiry, args.assetid, args.processes)
+        return
+
+    if plan.mass:
+        _fund_mass(client, seed, plan, args.expiry, args.assetid)
+    else:
+        _fund_batches(client, seed, plan, args.expiry, args.assetid)
 
 def fund_run(args):
-    # get batch and calculate funds required
-    foils = Foil.get_batch(db_session, args.batch)
-    required_funds = 0
-    for foil in foils:
-        required_funds += args.amount
-    print(f"Required zap: {required_funds}")
+    # plan the funding of the batch, transfers pay the asset's fee, looked up once even when only signing
+    client = _node_client(args)
+    plan = plan_funding(db_session, [(args.batch, args.amount)], args.mass_transfer, get_asset_fee(client, args.assetid))
+    plan.print()
 
     # get seed from user
     seed = getpass.getpass("Seed: ")
 
-    _fund(seed, args.batch, args.amount, args.expiry, required_funds, args.assetid)
+    _fund_plan(args, client, seed, plan)
 
 def fund_multiple_run(args):
-    # read batch spec file
-    with open(args.filename, "r") as f:
-        batch_spec = json.loads(f.read())
-
-    # get batches and calculate funds required
-    required_funds = 0
-    for batch in batch_spec:
-        foils = Foil.get_batch(db_session, batch[0])
-        for foil in foils:
-            required_funds += batch[1]
-    print(f"Required zap: {required_funds}")
+    # plan the funding of the batches in the spec, or in a plan written by create_batch_spec.py
+    client = _node_client(args)
+    plan = plan_funding(db_session, read_spec(args.filename), args.mass_transfer, get_asset_fee(client, args.assetid))
+    plan.print()
 
     # get seed from user
     seed = getpass.getpass("Seed: ")
 
-    for batch in batch_spec:
-        required_funds = 0
-        foils = Foil.get_batch(db_session, batch[0])
-        for foil in foils:
-            required_funds += batch[1]
-        _fund(seed, batch[0], batch[1], args.expiry, required_funds, args.assetid)
+    _fund_plan(args, client, seed, plan)
 
 def check_multiple_run(args):
-    # read batch spec file
-    with open(args.filename, "r") as f:
-        batch_spec = json.loads(f.read())
+    # the batches of the spec that have foils, checked in one stream
+    plan = plan_funding(db_session, read_spec(args.filename))
+    batches = [batch for batch, amount, foils, unfunded in plan.batches if foils]
+
+    client = _node_client(args)
+    errors = _check(client, Foil.iter_batches(db_session, batches), plan.amounts, args.assetid, args.indexed)
+
+    if errors:
+        print(f"\n{len(errors)} foils failed the check:")
+        for batch, address, balance, reason in errors:
+            print(f" - b{batch} {address}: {reason} ({balance})")
+        sys.exit(EXIT_CHECK_FAILED)
+
+def _confirm(client, chunk_size, grace):
+    # look up the status of every pending funding transaction, a few hundred ids per request and as many
+    # requests at a time as the client allows
+    foils_count = 0
+    txids_count = 0
+    counts = {}
+    date = time.time()
+    for foils in _chunks(Foil.iter_unconfirmed(db_session), chunk_size * client.concurrency):
+        by_txid = {}
+        for foil in foils:
+            by_txid.setdefault(foil.funding_txid, []).append(foil)
+        txids = list(by_txid)
+        chunks = [txids[i:i + chunk_size] for i in range(0, len(txids), chunk_size)]
+        missing = set()
+        dropped = set()
+        for statuses in client.map(client.transaction_statuses, chunks):
+            for status in statuses:
+                txid = status["id"]
+                for foil in by_txid.get(txid, []):
+                    if status["status"] == "confirmed":
+                        foil.funding_status = Foil.FUNDING_CONFIRMED
+                        foil.funding_height = status.get("height")
+                    elif status["status"] == "unconfirmed" or not foil.funding_date or date - foil.funding_date < grace:
+                        foil.funding_status = Foil.FUNDING_UNCONFIRMED
+                    elif foil.funding_status in (Foil.FUNDING_NOT_FOUND, Foil.FUNDING_DROPPED):
+                        # still not found, the foil can be funded again, the txid and expiry are kept so the
+                        # funding is confirmed if the transaction turns up after all
+                        if foil.funding_status == Foil.FUNDING_NOT_FOUND:
+                            dropped.add(txid)
+                        foil.funding_status = Foil.FUNDING_DROPPED
+                    else:
+                        # a node that is behind, or of the other network, does not know the transaction either, so
+                        # it only counts as dropped when it is still not found on the next run
+                        foil.funding_status = Foil.FUNDING_NOT_FOUND
+                        missing.add(txid)
+                    counts[foil.funding_status] = counts.get(foil.funding_status, 0) + 1
+                if txid in missing:
+                    print(f"funding tx {txid} not found, {len(by_txid[txid])} foils are dropped if it is still missing on the next run")
+                if txid in dropped:
+                    print(f"funding tx {txid} not found again, dropped {len(by_txid[txid])} foils so they are funded again")
+        # signed funding of dropped transactions can be signed again
+        JournalEntry.mark_failed(db_session, JournalEntry.KIND_FUND, dropped, "dropped, not found on chain")
+        db_session.commit()
+        foils_count += len(foils)
+        txids_count += len(txids)
+    summary = ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+    print(f"checked {foils_count} foils in {txids_count} transactions - {summary}")
 
-    for batch in batch_spec:
-        foils = Foil.get_batch(db_session, batch[0])
-        _check(batch[0], batch[1], args.assetid)
+def confirm_run(args):
+    client = _node_client(args)
+    while True:
+        _confirm(client, args.chunk_size, args.grace)
+        if not args.follow:
+            break
+        time.sleep(args.follow)
+
+def reconcile_run(args):
+    # expected amounts come from the batch spec or plan if given, otherwise from the foils
+    amounts = {}
+    if args.spec:
+        amounts = dict(read_spec(args.spec))
+
+    # hash the foils in the range by address, keeping only the columns the report needs
+    foils = Foil.iter_batches_between(db_session, args.batch_start, args.batch_end)
+    by_address = dict((foil_address(foil), (foil.batch, foil.funding_txid, foil.amount)) for foil in foils)
+
+    # stream the asset distribution once and join it against the foils
+    client = _node_client(args)
+    height = client.height() - 1
+    print(f"reading distribution of {args.assetid} at height {height}..")
+    balances = {}
+    holders = 0
+    for address, balance in client.distribution(args.assetid, height):
+        holders += 1
+        if address in by_address:
+            balances[address] = balance
+    print(f"{holders} holders, {len(balances)} of them foils in batches {args.batch_start} - {args.batch_end}")
+
+    # report per batch
+    reports = {}
+    problems = 0
+    for address, (batch, funding_txid, foil_amount) in by_address.items():
+        report = reports.setdefault(batch, {"ok": [], "wrong amount": [], "empty": [], "unexpected": []})
+        balance = balances.get(address, 0)
+        amount = amounts.get(batch, foil_amount)
+        if not funding_txid and batch not in amounts:
+            status = "unexpected" if balance > 0 else "ok"
+        elif balance == 0:
+            status = "empty"
+        elif amount and not _balance_ok(balance, amount):
+            status = "wrong amount"
+        else:
+            status = "ok"
+        report[status].append((address, balance))
+    for batch in sorted(reports):
+        report = reports[batch]
+        counts = ", ".join(f"{status}: {len(report[status])}" for status in report)
+        print(f":: batch {batch} - {counts}")
+        for status in ("wrong amount", "unexpected"):
+            for address, balance in report[status]:
+                print(f"   {status}: {address} ({balance})")
+                problems += 1
+        if args.verbose:
+            for address, balance in report["empty"]:
+                print(f"   empty: {address}")
+
+    if problems:
+        sys.exit(EXIT_CHECK_FAILED)
+
+def _received(tx, address):
+    # the amount of a transfer or mass transfer paid to address
+    if tx["type"] == 4:
+        return tx["amount"] if tx["recipient"] == address else 0
+    if tx["type"] == 11:
+        return sum(t["amount"] for t in tx["transfers"] if t["recipient"] == address)
+    return 0
+
+def _find_funding(client, address):
+    # the funding is the oldest transfer of zap to the address, however long its history is
+    funding = None
+    amount = 0
+    for tx in client.address_transactions(address):
+        if tx.get("assetId") not in (MAINNET_ASSETID, TESTNET_ASSETID):
+            continue
+        received = _received(tx, address)
+        if received:
+            funding = tx
+            amount = received
+    return funding, amount
 
 def fill_missing_fund_data_run(args):
     two_months = 60 * 60 * 24 * 30 * 2
-    foils = Foil.get_batches_between(db_session, args.batch_start, args.batch_end)
-    for foil in foils:
-        if not foil.funding_txid:
-            addr = pw.Address(seed=foil.seed)
-            print(f":: b{foil.batch}, addr: {addr.address} - no funding tx ::")
-            api = f"/transactions/address/{addr.address}/limit/100"
-            txs = pw.wrapper(api)[0]
-            if len(txs) >= 100:
-                print("ERROR: too many txs")
-                sys.exit(EXIT_TOO_MANY_TXS)
-            tx = txs[len(txs)-1]
-            if tx["type"] != 4:
-                print("ERROR: tx not 'transfer asset' type")
-                sys.exit(EXIT_NOT_TRANSFER_ASSET)
-            if not tx["assetId"] in (MAINNET_ASSETID, TESTNET_ASSETID):
-                print("ERROR: unrecognised asset id")
-                sys.exit(EXIT_UNRECOGNISED_ASSET_ID)
-            if tx["recipient"] != addr.address:
-                print("ERROR: wrong recipeint")
-                sys.exit(EXIT_WRONG_RECIPIENT)
-            funding_txid = tx["id"]
-            funding_date = int(tx["timestamp"] / 1000)
-            expiry = funding_date + two_months
-            amount = tx["amount"]
-
-            print(f"   found funding: {amount} ZAP CENTS")
-            print(f"   setting expiry: {expiry}, funding_txid: {funding_txid}")
-
-            foil.expiry = expiry
-            foil.funding_date = funding_date
-            foil.funding_txid = funding_txid
-            foil.amount = amount
+    foils = Foil.iter_batches_between(db_session, args.batch_start, args.batch_end)
+    foils = (foil for foil in foils if not foil.funding_txid)
+
+    def lookup(address):
+        try:
+            return _find_funding(client, address) + (None,)
+        except requests.RequestException as ex:
+            return None, 0, str(ex)
+
+    # look up a chunk of foils at a time and commit what was found before the next
+    client = _node_client(args)
+    chunk_size = 100
+    errors = []
+    count = 0
+    for chunk in _chunks(foils, chunk_size):
+        addresses = [foil_address(foil) for foil in chunk]
+        updates = []
+        for foil, address, (tx, amount, error) in zip(chunk, addresses, client.map(lookup, addresses)):
+            if error:
+                errors.append((foil.batch, address, f"node request failed: {error}"))
+            elif not tx:
+                errors.append((foil.batch, address, "no zap transfer to the address found"))
+            else:
+                funding_txid = tx["id"]
+                funding_date = int(tx["timestamp"] / 1000)
+                expiry = funding_date + two_months
+                print(f":: b{foil.batch}, addr: {address} - found funding: {amount} ZAP CENTS")
+                print(f"   setting expiry: {expiry}, funding_txid: {funding_txid}")
+
+                updates.append(Foil.funding_update(foil.id, funding_txid, funding_date, expiry, amount))
+                count += 1
+        db_session.bulk_update_mappings(Foil, updates)
+        db_session.commit()
+    print(f"filled in the funding of {count} foils")
+
+    if errors:
+        print(f"\n{len(errors)} foils failed:")
+        for batch, address, reason in errors:
+            print(f" - b{batch} {address}: {reason}")
+        sys.exit(EXIT_FILL_FAILED)
+
+def addresses_run(args):
+    if args.force:
+        foils = Foil.iter_all(db_session)
+        count = Foil.count(db_session)
+    else:
+        foils = Foil.iter_missing_address(db_session)
+        count = Foil.count_missing_address(db_session)
+    print(f"deriving {count} addresses..")
+
+    # only the id and seed are kept, the foils expire with every commit
+    chunk_size = 1000
+    seeds = ((foil.id, foil.stored_seed) for foil in foils)
+    updates = []
+    for (foil_id, seed), address in derive_addresses(seeds, args.processes, lambda item: item[1]):
+        updates.append({"id": foil_id, "address": address})
+        if len(updates) >= chunk_size:
+            db_session.bulk_update_mappings(Foil, updates)
+            db_session.commit()
+            updates = []
+            print(f"stored up to foil {foil_id}")
+    db_session.bulk_update_mappings(Foil, updates)
     db_session.commit()
 
+def compact_run(args):
+    # foils with a text seed, the ones compacted drop out so the pages only move forward
+    criterion = Foil.seed != None
+    compacted = kept = 0
+    for chunk in Foil.iter_row_pages(db_session, (Foil.id, Foil.seed), criterion):
+        updates = []
+        for foil_id, seed in chunk:
+            entropy = seed_entropy(seed)
+            if entropy is None:
+                kept += 1
+            else:
+                updates.append({"id": foil_id, "seed": None, "seed_entropy": entropy})
+        db_session.bulk_update_mappings(Foil, updates)
+        db_session.commit()
+        compacted += len(updates)
+        print(f"compacted {compacted} seeds")
+    if kept:
+        print(f"kept {kept} seeds that are not 12 word bip39 mnemonics")
+    if args.vacuum and db_session.bind.dialect.name == "sqlite":
+        print("vacuuming..")
+        db_session.close()
+        with db_session.bind.connect() as conn:
+            conn.execute("VACUUM")
+
 def show_run(args):
-    pw.setOffline()
-    if args.batch or args.batch == 0:
-        foils = Foil.get_batch(db_session, args.batch)
-    else:
-        foils = Foil.all(db_session)
-    for foil in foils:
-        json = foil.to_json()
+    fields = tuple(args.fields.split(",")) if args.fields else FOIL_FIELD_NAMES
+    unknown = [name for name in fields if name not in FOIL_FIELD_NAMES]
+    if unknown:
+        print(f"ERROR: unknown fields {', '.join(unknown)}, choose from {', '.join(FOIL_FIELD_NAMES)}")
+        sys.exit(EXIT_INVALID_FIELDS)
+
+    # filter in the database
+    batch_end = args.batch_end if args.batch_end is not None else args.batch
+    funded = True if args.funded else False if args.unfunded else None
+    expired = True if args.expired else False if args.unexpired else None
+    criterion = Foil.criterion(args.batch, batch_end, funded, expired, args.amount)
+
+    # select only the fields, and after them what the balance lookups need and the entropy compacted seeds are
+    # turned back into mnemonics from
+    columns = [getattr(Foil, name) for name in fields]
+    if args.check:
+        columns += [Foil.address, Foil.seed]
+    seed_index = fields.index("seed") if "seed" in fields else None
+    entropy_index = len(columns)
+    if seed_index is not None or args.check:
+        columns.append(Foil.seed_entropy)
+    if args.indexed:
+        columns.append(Foil.id)
+    count = len(fields)
+    trim = len(columns) > count
+    serialize = foil_json_line(fields) if args.jsonl else foil_serializer(fields)
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+    for chunk in Foil.iter_row_pages(db_session, columns, criterion):
+        if seed_index is not None:
+            chunk = [row if row[seed_index] is not None else \
+                row[:seed_index] + (foil_seed(None, row[entropy_index]),) + row[seed_index + 1:] for row in chunk]
         if args.check:
-            addr = pw.Address(seed=foil.seed)
-            balance = addr.balance(assetId=args.assetid)
-            json["balance"] = balance
-        print(json)
+            addresses = [stored_address(row[count], row[count + 1] or row[entropy_index]) for row in chunk]
+            balances = _node_client(args).balances(addresses, args.assetid)
+        if args.indexed:
+            indexed = FoilTransfer.balances(db_session, [row[-1] for row in chunk])
+        lines = []
+        for row in chunk:
+            # the serializers only take the fields
+            values = row[:count] if trim else row
+            extra = {}
+            if args.check:
+                extra["balance"] = next(balances)
+            if args.indexed:
+                balance, redemption_txid = indexed.get(row[-1], (0, None))
+                extra["indexed_balance"] = balance
+                extra["redemption_txid"] = redemption_txid
+            if args.jsonl:
+                line = serialize(values)
+                if extra:
+                    line = f"{line[:-1]},{encode(extra)[1:]}"
+            else:
+                foil = serialize(values)
+                foil.update(extra)
+                line = str(foil)
+            lines.append(line)
+        lines.append("")
+        sys.stdout.write("\n".join(lines))
+
+def index_run(args):
+    if args.fixture:
+        source = FixtureBlockSource(args.fixture)
+    else:
+        source = NodeBlockSource(_node_client(args))
+    indexer = Indexer(db_session, source, args.assetid, args.rollback_depth)
+    while True:
+        indexer.run(args.start)
+        if not args.follow:
+            break
+        time.sleep(args.follow)
 
 def images_run(args):
-    pw.setOffline()
-    # consts
-    ppi = 72 # points per inch
-    dpi = 300
-    mm_per_in = 25.4
-
-    # page size
-    width_mm = 160
-    height_mm = 120
-    width_in = width_mm / mm_per_in
-    height_in = height_mm / mm_per_in
-    width = width_in * dpi
-    height = height_in * dpi
-    width_pts = width_in * ppi
-    height_pts = height_in * ppi
-
-    # qrcode width and y position
-    qrcode_x_center_mm = 20.4 + (39/2.0)
-    qrcode_y_center_mm = 22.1 + (39/2.0)
-    qrcode_x_center = qrcode_x_center_mm / mm_per_in * dpi
-    qrcode_y_center = qrcode_y_center_mm / mm_per_in * dpi
-    qrcode_width_mm = 39
-
-    # calc qrcode pix values
-    qrcode_width = qrcode_width_mm / mm_per_in * dpi
-    qrcode_border = 0
-    qrcode_boxes = 37 + qrcode_border + qrcode_border
-    qrcode_box_size = int(qrcode_width / qrcode_boxes)
-
-    # batch text
-    font_size = 30
-    font = ImageFont.truetype("Andale Mono.ttf", font_size)
-    text_x_center_mm = 29.3 + (21.5/2.0)
-    text_y_center_mm = 120 - 9 - (8.9/2.0)
-    text_x_center = text_x_center_mm / mm_per_in * dpi
-    text_y_center = text_y_center_mm / mm_per_in * dpi
+    # reportlab, pillow and qrcode are only needed here
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+    from render import Layout, Imposition, SheetPlacer, PagePlacer, render_png, render_pngs, register_pdf_font, \
+        draw_vector_page
+    from image_cache import ImageCache, fingerprint, foil_hash
+
+    layout = Layout()
+    imposition = None
+    if args.sheet:
+        columns, rows = None, None
+        if args.grid:
+            m = re.match(r"^(\d+)x(\d+)$", args.grid)
+            if not m:
+                print("ERROR: grid must be columns x rows, like 2x2")
+                sys.exit(EXIT_IMAGES_FAILED)
+            columns, rows = int(m.group(1)), int(m.group(2))
+        try:
+            imposition = Imposition(layout, args.sheet, columns, rows, args.gutter, not args.no_crop_marks)
+        except ValueError as ex:
+            print(f"ERROR: {ex}")
+            sys.exit(EXIT_IMAGES_FAILED)
+        print(f"imposing {imposition.columns}x{imposition.rows} foils per {args.sheet} sheet")
 
     # create image directory
     path = "images"
     if not os.path.exists(path):
         os.makedirs(path)
 
-    # create pdf
-    fn = os.path.join(path, "images.pdf")
-    pdf = canvas.Canvas(fn, pagesize=(width_pts, height_pts))
+    # pages are cached by the hash of their layout, batch and seed, and pdfs by the hash of the pages in them
+    # and how they are drawn, so a run only renders new foils and writes pdfs that changed
+    cache = ImageCache(path, not args.force)
+    layout_fingerprint = layout.fingerprint()
+    options = fingerprint(layout_fingerprint, args.vector, args.sheet, args.grid, args.gutter, args.no_crop_marks)
+    columns = (Foil.id, Foil.batch, Foil.seed, Foil.seed_entropy)
+    criterion = Foil.criterion(args.batch, args.batch_end)
 
-    foils = Foil.all(db_session)
-    for foil in foils:
-        filename = f"b{foil.batch}_{foil.id}.png"
-        filename = os.path.join(path, filename)
-
-        # create qr code image
-        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, \
-            box_size=qrcode_box_size, border=qrcode_border)
-        qr.add_data(foil.seed)
-        qr.make()
-        qr_img = qr.make_image(fill_color="black", back_color="transparent")
-
-        # create template image
-        template = PIL.Image.new("RGBA", (int(width), int(height)))
-        # draw batch text
-        d = PIL.ImageDraw.Draw(template)
-        text = f"b{foil.batch}"
-        text_width, text_height = font.getsize(text)
-        text_x = text_x_center - (text_width / 2)
-        text_y = text_y_center - (text_height / 2)
-        d.text((int(text_x), int(text_y)), text, font=font, fill="black")
-        # paste qr code
-        qrcode_x = qrcode_x_center - (qr_img.size[0] / 2)
-        qrcode_y = qrcode_y_center - (qr_img.size[1] / 2)
-        template.paste(qr_img, (int(qrcode_x), int(qrcode_y)))
-
-        # save image
-        print(filename)
-        template.save(filename)
-
-        # add page to pdf
-        pdf.drawImage(filename, 0, 0, width_pts, height_pts, mask="auto")
-        pdf.showPage()
-
-    # save pdf
-    print("saving pdf..")
-    pdf.save()
+    def foils(criterion):
+        # (id, batch, mnemonic), pages are hashed by the mnemonic so compacting seeds renders nothing again
+        for id, batch, seed, entropy in Foil.iter_rows(db_session, columns, criterion):
+            yield id, batch, foil_seed(seed, entropy)
+
+    # a batch with the same highest foil id and number of foils as when its pages were last hashed is unchanged,
+    # its digest is taken from the manifest without reading its foils, unless the png of every foil is wanted
+    summaries = Foil.batch_summaries(db_session, criterion)
+    digests = {}
+    changed = []
+    for batch, summary in sorted(summaries.items()):
+        digest = None if args.png else cache.batch_digest(batch, summary, layout_fingerprint)
+        if digest:
+            digests[batch] = digest
+        else:
+            changed.append(batch)
+    print(f"{len(changed)} of {len(summaries)} batches changed")
+
+    def scan():
+        # the foils of the changed batches with the hash of their page, a batch is digested once all its foils
+        # have been read
+        for changed_batch in changed:
+            digest = hashlib.sha256()
+            for id, batch, seed in foils(Foil.criterion(changed_batch, changed_batch)):
+                hash = foil_hash(layout_fingerprint, batch, seed)
+                digest.update(f"{id}:{hash}".encode())
+                yield id, batch, seed, hash
+            digests[changed_batch] = digest.hexdigest()
+
+    def missing():
+        for foil in scan():
+            if not cache.has_png(foil[3]):
+                yield foil
+            elif args.png:
+                png_filename = os.path.join(path, f"b{foil[1]}_{foil[0]}.png")
+                if not os.path.exists(png_filename):
+                    shutil.copyfile(cache.png_filename(foil[3]), png_filename)
+
+    if args.vector:
+        for foil in scan():
+            pass
+    else:
+        # render the pages that are not cached, without starting the render processes when there are none
+        pending = missing()
+        first = next(pending, None)
+        rendered = 0
+        if first:
+            for (id, batch, seed, hash), png in render_pngs(itertools.chain([first], pending), args.processes, \
+                    lambda foil: (foil[1], foil[2])):
+                cache.write_png(hash, png)
+                if args.png:
+                    filename = os.path.join(path, f"b{batch}_{id}.png")
+                    print(filename)
+                    with open(filename, "wb") as f:
+                        f.write(png)
+                rendered += 1
+        print(f"rendered {rendered} pages")
+    # the manifest is only written once every page is on disk, a run that was interrupted finds the pages it
+    # rendered in the cache
+    for batch in changed:
+        cache.set_batch(batch, summaries[batch], layout_fingerprint, digests[batch])
+    cache.save()
+
+    def write_pdf(filename, rows):
+        if imposition:
+            pdf = canvas.Canvas(filename, pagesize=imposition.size)
+            placer = SheetPlacer(pdf, imposition)
+        else:
+            pdf = canvas.Canvas(filename, pagesize=(layout.width_pts, layout.height_pts))
+            placer = PagePlacer(pdf)
+        for id, batch, seed in rows:
+            x, y = placer.next()
+            if args.vector:
+                with METRICS.timer("render_seconds"):
+                    pdf.saveState()
+                    pdf.translate(x, y)
+                    draw_vector_page(pdf, layout, batch, seed)
+                    pdf.restoreState()
+            else:
+                hash = foil_hash(layout_fingerprint, batch, seed)
+                try:
+                    png = cache.read_png(hash)
+                except FileNotFoundError:
+                    # removed from the cache since it was rendered
+                    png = render_png(layout, batch, seed)
+                    cache.write_png(hash, png)
+                with METRICS.timer("pdf_page_seconds"):
+                    pdf.drawImage(ImageReader(io.BytesIO(png)), x, y, layout.width_pts, layout.height_pts, mask="auto")
+            placer.end()
+        placer.finish()
+        with METRICS.timer("pdf_save_seconds"):
+            pdf.save()
+
+    if args.vector:
+        register_pdf_font()
+    if args.per_batch:
+        pdfs = [(os.path.join(path, f"b{batch}.pdf"), fingerprint(options, digests[batch]), Foil.criterion(batch, batch)) \
+            for batch in sorted(digests)]
+    else:
+        hash = fingerprint(options, args.batch, args.batch_end, [digests[batch] for batch in sorted(digests)])
+        pdfs = [(os.path.join(path, "images.pdf"), hash, criterion)]
+    written = 0
+    for filename, hash, pdf_criterion in pdfs:
+        if cache.pdf_current(filename, hash):
+            continue
+        print(f"saving {filename}..")
+        write_pdf(filename, foils(pdf_criterion))
+        cache.set_pdf(filename, hash)
+        cache.save()
+        written += 1
+    print(f"{written} pdfs written, {len(pdfs) - written} up to date")
 
 def csv_run(args):
-    pw.setOffline()
-    foils = Foil.get_batches_starting_at(db_session, args.batch)
-    with open("codes.csv", "w") as f:
-        data = "batch,"
-        if args.seeds:
-            data += "seed"
+    funded = True if args.funded else False if args.unfunded else None
+    criterion = Foil.criterion(args.batch, args.batch_end, funded)
+    if args.seeds:
+        columns = ("batch", "seed")
+        types = (int, str)
+        rows = Foil.iter_rows(db_session, (Foil.batch, Foil.seed, Foil.seed_entropy), criterion)
+        rows = ((batch, foil_seed(seed, entropy)) for batch, seed, entropy in rows)
+    else:
+        columns = ("batch", "address", "amount", "funding_txid", "funding_date")
+        types = (int, str, int, str, float)
+        rows = Foil.iter_rows(db_session, (Foil.batch, Foil.address, Foil.seed, Foil.seed_entropy, Foil.amount, \
+            Foil.funding_txid, Foil.funding_date), criterion)
+        # the seed is only turned into a mnemonic when the address has to be derived
+        rows = ((batch, stored_address(address, seed or entropy), amount, funding_txid, funding_date) \
+            for batch, address, seed, entropy, amount, funding_txid, funding_date in rows)
+
+    fmt = args.format or format_from_path(args.output)
+    compress = args.gzip or args.output.endswith(".gz")
+    if args.output != "-":
+        print(f"exporting {fmt} to {args.output}..")
+    try:
+        export_rows(args.output, fmt, columns, types, rows, compress)
+    except RuntimeError as ex:
+        print(f"ERROR: {ex}")
+        sys.exit(EXIT_EXPORT_FAILED)
+
+def _broadcast_entries(client, entries, rate):
+    # broadcast each signed transaction once, even when it covers several foils, and record the outcome
+    limiter = RateLimiter(rate)
+    by_txid = {}
+    for entry in entries:
+        by_txid.setdefault(entry.txid, []).append(entry)
+
+    # read the signed data up front, the entries expire on every commit and must not be reloaded from worker threads
+    payloads = SignedTransaction.payloads(db_session, entries)
+    # the foils of each funding transaction with the expiry and amount to record once it is sent, in the commit of
+    # its status so a rerun after a crash finds every foil as it left it, swept foils are only marked once a
+    # balance check finds them empty
+    fund_foils = dict((txid, [(entry.foil_id, entry.expiry, entry.amount) for entry in entries]) \
+        for txid, entries in by_txid.items() if entries[0].kind == JournalEntry.KIND_FUND)
+    funded = []
+    recorded = 0
+
+    def broadcast(txid):
+        api, data = payloads[txid]
+        if signed_age(data) > MAX_SIGNED_AGE:
+            return {"error": "expired", "message": "signed too long ago, sign it again"}
+        limiter.wait()
+        try:
+            return client.broadcast(api, data)
+        except requests.RequestException as e:
+            return {"error": "request", "message": str(e)}
+
+    sent = 0
+    txids = list(by_txid)
+    for i, (txid, result) in enumerate(zip(txids, client.map(broadcast, txids))):
+        error = None
+        if "error" not in result or "already in the" in str(result.get("message")):
+            status = JournalEntry.STATUS_BROADCAST
+            sent += 1
+            date = time.time()
+            funded += [Foil.funding_update(foil_id, txid, date, expiry, amount) \
+                for foil_id, expiry, amount in fund_foils.get(txid, [])]
+        elif result["error"] == "expired":
+            status = JournalEntry.STATUS_EXPIRED
+            error = result["message"]
+        elif result["error"] == "request":
+            # the node may have taken it before the request failed, the same transaction is sent again on the
+            # next broadcast instead of signing a new one that could move the funds twice
+            status = JournalEntry.STATUS_SIGNED
+            error = result["message"]
         else:
-            data += "address,amount,funding_txid,funding_date"
-        f.write(data + "\n")
-        for foil in foils:
-            addr = pw.Address(seed=foil.seed)
-            data = f"{foil.batch},"
-            if args.seeds:
-                data += f"\"{foil.seed}\""
+            status = JournalEntry.STATUS_FAILED
+            error = str(result.get("message"))
+        for entry in by_txid[txid]:
+            entry.status = status
+            entry.error = error
+        METRICS.count("broadcasts", status=status)
+        print(f"{status} {txid} ({len(by_txid[txid])} foils) {error or ''}")
+        if i % 100 == 99:
+            db_session.bulk_update_mappings(Foil, funded)
+            db_session.commit()
+            recorded += len(funded)
+            funded = []
+    db_session.bulk_update_mappings(Foil, funded)
+    db_session.commit()
+    recorded += len(funded)
+    print(f"broadcast {sent} of {len(txids)} transactions")
+    if fund_foils:
+        print(f"Recorded funding of {recorded} foils")
+    return sent
+
+def broadcast_run(args):
+    # send the signed transactions waiting in the journal
+    entries = JournalEntry.with_status(db_session, args.kind, JournalEntry.STATUS_SIGNED)
+    if args.retry_failed:
+        entries += JournalEntry.with_status(db_session, args.kind, JournalEntry.STATUS_FAILED)
+    print(f"{len(entries)} {args.kind} journal entries to broadcast")
+    # the funding of the foils is recorded as each transaction is sent
+    _broadcast_entries(_node_client(args, args.retries), entries, args.rate)
+
+def _due_sweeps(client, foils, assetid, asset_fee, ignore_expiry, indexed, resume, done):
+    # find expired foils that have not been swept yet, returning (foil id, seed, amount) for each, adding
+    # sweeps that were signed but not broadcast to resume and the ids of foils with nothing to sweep to done
+    date = time.time()
+
+    def expired(foil):
+        # only funded foils past their expiry go in done, a foil swept early or before it was funded has to be
+        # found by sweep_due again once it is funded and expires
+        return foil.funded and foil.expiry and date >= foil.expiry
+
+    journal = JournalEntry.latest(db_session, JournalEntry.KIND_SWEEP, [foil.id for foil in foils])
+    payloads = SignedTransaction.payloads(db_session, [entry for entry in journal.values() \
+        if entry.status in (JournalEntry.STATUS_SIGNED, JournalEntry.STATUS_BROADCAST)])
+    due = []
+    for foil in foils:
+        if not (ignore_expiry or expired(foil)):
+            print(f"Skipping {foil.batch} {foil_address(foil)}, not funded or not yet expired")
+            continue
+        entry = journal.get(foil.id)
+        if entry and foil.funding_date and entry.date < foil.funding_date:
+            # a sweep of an earlier funding, the foil was funded again since
+            entry = None
+        if entry and entry.status == JournalEntry.STATUS_SIGNED and signed_age(payloads[entry.txid][1]) < MAX_SIGNED_AGE:
+            resume.append(entry)
+            continue
+        due.append((foil, entry))
+
+    # fetch balances, a sweep that was sent is only trusted once the balance has gone, the node may have dropped it
+    addresses = [foil_address(foil) for foil, entry in due]
+    if indexed:
+        balances = _indexed_balances([foil for foil, entry in due])
+    else:
+        balances = client.balances(addresses, assetid)
+    sweeps = []
+    for (foil, entry), address, balance in zip(due, addresses, balances):
+        sent = entry and entry.status == JournalEntry.STATUS_BROADCAST
+        if balance <= asset_fee:
+            if sent:
+                print(f"Skipping {foil.batch} {address}, already swept in {entry.txid}")
             else:
-                data += f"{addr.address},{foil.amount},{foil.funding_txid},{foil.funding_date}"
-            f.write(data + "\n")
-            sys.stdout.write(".")
-            sys.stdout.flush()
+                print(f"Skipping {foil.batch} {address}, balance is {balance}")
+            if expired(foil):
+                done.append(foil.id)
+            continue
+        if sent and signed_age(payloads[entry.txid][1]) < MAX_SIGNED_AGE:
+            # not in a block yet, or dropped, the same transaction is sent again so the foil is never swept twice
+            print(f"Resending {foil.batch} {address}, swept in {entry.txid} but the balance is still {balance}")
+            resume.append(entry)
+            continue
+        sweeps.append((foil.id, foil.mnemonic, balance - asset_fee))
+    return sweeps
+
+def _sweep(client, args, asset_fee, chunks, ignore_expiry):
+    # sign, journal and broadcast the sweeps of chunks of foils, returns the number of foils swept and of foils
+    # found empty
+    resume = []
+    done = []
+    sweeps = (sweep for chunk in chunks \
+        for sweep in _due_sweeps(client, chunk, args.assetid, asset_fee, ignore_expiry, args.indexed, resume, done))
+
+    # sign in parallel and journal each chunk of signed transactions before broadcasting it
+    job = lambda sweep: (sweep[1], args.recipient, args.assetid, sweep[2], asset_fee, args.assetid)
+    entries = []
+    signed = 0
+    total = 0
+    sent = 0
+    for (foil_id, seed, amount), (txid, api, data) in sign_transfers(sweeps, args.processes, job):
+        entry = JournalEntry(foil_id, JournalEntry.KIND_SWEEP, txid, amount, JournalEntry.STATUS_SIGNED, time.time())
+        db_session.add(SignedTransaction(txid, api, data))
+        db_session.add(entry)
+        entries.append(entry)
+        signed += 1
+        total += amount
+        if len(entries) >= STREAM_CHUNK_SIZE:
+            db_session.commit()
+            sent += _broadcast_entries(client, entries, args.rate)
+            entries = []
+    db_session.commit()
+    print(f"Signed {signed} sweeps of {total} in total, resuming {len(resume)}")
+
+    # broadcast the rest
+    sent += _broadcast_entries(client, entries + resume, args.rate)
+
+    # foils found empty are not looked at again, the ones swept now are once their balance has gone
+    Foil.mark_swept(db_session, done, int(time.time()))
+    db_session.commit()
+    return sent, len(done)
 
 def sweep_run(args):
-    pw.setOnline()
     # check recipient is a valid address
     if not pw.validateAddress(args.recipient):
         print(f"ERROR: {args.recipient} is not a valid address")
         sys.exit(EXIT_INVALID_RECIPIENT)
-    recipient = pw.Address(args.recipient)
 
-    # sweep expired foils
-    asset = pw.Asset(args.assetid)
-    asset_fee = get_asset_fee(args.assetid)
-    date = time.time()
-    foils = Foil.get_batches_between(db_session, args.batch_start, args.batch_end)
-    for foil in foils:
-        if args.ignore_expiry or foil.expiry and date >= foil.expiry:
-            addr = pw.Address(seed=foil.seed)
-            balance = addr.balance(assetId=args.assetid)
-            if balance == 0:
-                print(f"Skipping {foil.batch} {addr.address}, balance is 0")
-                continue
-            result = addr.sendAsset(recipient, asset, balance - asset_fee, \
-                feeAsset=asset, txFee=asset_fee)
-            print(result)
-            print(f"Swept {foil.batch} {addr.address}, txid {result['id']}")
-        else:
-            print(f"Skipping {foil.batch} {addr.address}, not yet expired")
+    client = _node_client(args)
+    asset_fee = get_asset_fee(client, args.assetid)
+    foils = Foil.iter_batches_between(db_session, args.batch_start, args.batch_end)
+    _sweep(client, args, asset_fee, _chunks(foils, STREAM_CHUNK_SIZE), args.ignore_expiry)
+
+def sweep_due_run(args):
+    # sweep foils as they expire, the swept/expiry index finds them without scanning batch ranges
+    if not pw.validateAddress(args.recipient):
+        print(f"ERROR: {args.recipient} is not a valid address")
+        sys.exit(EXIT_INVALID_RECIPIENT)
+
+    client = _node_client(args)
+    asset_fee = get_asset_fee(client, args.assetid)
+
+    def due(date):
+        # one pass over the foils expired by date, a chunk at a time, foils that could not be swept are
+        # tried again on the next pass
+        after = None
+        while True:
+            foils = Foil.due_for_sweep(db_session, date, after, args.limit)
+            if not foils:
+                break
+            after = (foils[-1].expiry, foils[-1].id)
+            yield foils
+            if len(foils) < args.limit:
+                break
+
+    while True:
+        date = int(time.time())
+        try:
+            sent, empty = _sweep(client, args, asset_fee, due(date), False)
+            print(f"{datetime.datetime.now().isoformat(timespec='seconds')}: swept {sent} foils, {empty} had nothing to sweep")
+        except requests.RequestException as ex:
+            if not args.interval:
+                raise
+            db_session.rollback()
+            print(f"ERROR: {ex}, trying again in {args.interval}s")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+def _profile(function, args):
+    # run the command under cProfile, dump the stats for pstats/snakeviz and summarise the hottest calls
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(function, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+
+# command: (function, whether it talks to the node through pywaves)
+COMMANDS = {
+    "create": (create_run, False),
+    "fund": (fund_run, True),
+    "fund_multiple": (fund_multiple_run, True),
+    "check_multiple": (check_multiple_run, True),
+    "confirm": (confirm_run, True),
+    "reconcile": (reconcile_run, True),
+    "fill_missing_fund_data": (fill_missing_fund_data_run, True),
+    "addresses": (addresses_run, False),
+    "compact": (compact_run, False),
+    "show": (show_run, False),
+    "images": (images_run, False),
+    "csv": (csv_run, False),
+    "sweep": (sweep_run, True),
+    "sweep_due": (sweep_due_run, True),
+    "broadcast": (broadcast_run, True),
+    "index": (index_run, True),
+}
+
+class _Timer:
+    # startup and run phases for --timing
+    def __init__(self, start):
+        self.phases = []
+        self.last = start
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        METRICS.gauge("phase_seconds", now - self.last, phase=name)
+        self.last = now
+
+    def report(self):
+        for name, duration in self.phases:
+            print(f"{name:>10}: {duration * 1000:8.1f} ms", file=sys.stderr)
+        print(f"{'total':>10}: {sum(d for n, d in self.phases) * 1000:8.1f} ms", file=sys.stderr)
 
 if __name__ == "__main__":
+    timer = _Timer(_start)
+    timer.phase("imports")
+
     # parse arguments
     parser = construct_parser()
     args = parser.parse_args()
+    if args.command not in COMMANDS:
+        parser.print_help()
+        sys.exit(EXIT_NO_COMMAND)
+    function, online = COMMANDS[args.command]
+    timer.phase("arguments")
 
-    # set chain and asset id
+    # set chain and asset id, only commands that use the node go online
     pw.setNode(TESTNET_NODE, "testnet", "T")
     args.assetid = TESTNET_ASSETID
     if args.mainnet:
         pw.setNode(MAINNET_NODE, "mainnet", "W")
         args.assetid = MAINNET_ASSETID
-    pw.setOnline()
-    print(f"Network: {pw.NODE} ({pw.CHAIN} - {pw.CHAIN_ID})")
+    if args.node:
+        pw.setNode(args.node, pw.CHAIN, pw.CHAIN_ID)
+    if online:
+        pw.setOnline()
+        print(f"Network: {pw.NODE} ({pw.CHAIN} - {pw.CHAIN_ID})", file=sys.stderr)
+    else:
+        pw.setOffline()
+    timer.phase("network")
 
     # initialise database
-    init_db()
-
-    # set appropriate function
-    function = None
-    if args.command == "create":
-        function = create_run
-    elif args.command == "fund":
-        function = fund_run
-    elif args.command == "fund_multiple":
-        function = fund_multiple_run
-    elif args.command == "check_multiple":
-        function = check_multiple_run
-    elif args.command == "fill_missing_fund_data":
-        function = fill_missing_fund_data_run
-    elif args.command == "show":
-        function = show_run
-    elif args.command == "images":
-        function = images_run
-    elif args.command == "csv":
-        function = csv_run
-    elif args.command == "sweep":
-        function = sweep_run
-    else:
-        parser.print_help()
-        sys.exit(EXIT_NO_COMMAND)
+    try:
+        init_db(args.db, args.db_pool_size, args.db_timeout)
+    except ImportError as ex:
+        print(f"ERROR: the database driver is not installed ({ex})")
+        sys.exit(EXIT_DB_FAILED)
+    METRICS.instrument_session(db_session)
+    timer.phase("database")
 
-    if function:
-        function(args)
+    try:
+        if args.profile:
+            _profile(function, args)
+        else:
+            function(args)
+    finally:
+        timer.phase("command")
+        if args.timing:
+            timer.report()
+        if args.metrics:
+            METRICS.write(args.metrics)